@@ -1,18 +1,20 @@
-from datetime import datetime
 from textwrap import fill
 import os
 import random
-import statistics
-import string
 
+import numpy
 from wand.color import Color
 from wand.drawing import Drawing
 from wand.image import Image
 
-from cache import cache
-from config import cfg
-from image_search import (image_search, ImageSearchResult,
-                          ImageSearchResultError)
+from cache import cache, LRUCache
+from config import cfg, settings
+from image_search import (image_search, ImageSearchResult, Lookahead,
+                          Prefetch)
+from scoring import Scorer
+import gif
+import layers
+from store import images
 import utils
 
 
@@ -28,9 +30,32 @@ class AkariWandIsRetardedError(Exception):
     pass
 
 
+class AkariBrokenImageError(Exception):
+    pass
+
+
+# captions rendered into premultiplied layers, keyed by text, caption type and
+# size, so the text is rasterized once instead of once per frame.
+caption_layers = LRUCache(maxsize=32)
+# masks shrunk to compose smaller animations when the system is busy
+shrunk_masks = LRUCache(maxsize=4)
+
+
 class Akari(object):
+    # max size in bytes of the resulting file
+    MAX_SIZE = 3072 * 1024
+
     def __init__(self, text, type='still', shuffle_results=False,
-                 caption=None, image_url=None):
+                 caption=None, image_url=None, frame_step=1, shrink=1,
+                 colors=256, composer=None):
+        """frame_step, shrink and colors make animations cheaper to compose
+            when the system is busy: only one of every frame_step masks is
+            used, the size is divided by shrink and the gif has that many
+            colours at most.
+            composer: if given, it's called as composer(akari, image) to
+            compose the image somewhere else, such as in another process,
+            while searching and downloading happen here. it returns the
+            composed Akari"""
         self.text = text
         # make hashtags searchable
         if '#' in self.text:
@@ -40,10 +65,25 @@ class Akari(object):
         if type not in ('still', 'animation'):
             raise ValueError('Incorrect Akari type "%s"' % type)
         self.type = type
+        self.frame_step = frame_step
+        self.shrink = shrink
+        self.colors = colors
+
+        akari_settings = settings().akari
+        self.override = settings().image_search.override
+        self.limit_results = akari_settings.limit_results
+        self.caption_type = akari_settings.caption_type
+        self.masks = akari_settings.frames
 
-        self.override = cfg('image_search:override:list')
-        self.limit_results = cfg('akari:limit_results:int')
-        self.caption_type = cfg('akari:caption_type')
+        if 'akari:masks' not in cache:
+            # cache miss
+            utils.logger.warning('Akari frames were not warmed up!')
+            self.warmup()
+
+        if self.type == 'animation' and len(cache.get('akari:masks')) < 2:
+            # if we were asked to generate an animation but there's only one
+            # mask, then we're generating a still image
+            self.type = 'still'
 
         if image_url:
             result = ImageSearchResult(image_url, 'overridden', 'overridden')
@@ -63,27 +103,49 @@ class Akari(object):
                 # results are always shuffled if # of results is uncapped
                 random.shuffle(results)
 
+        # if any of the results has been rendered already with this same
+        # caption, that's it. no need to download or compose anything.
         for result in results:
-            # first, download the result. if it fails, continue for the next
-            try:
-                result.download()
-            except ImageSearchResultError as exc:
-                utils.logger.info('Error downloading this result: %s', exc)
-                continue
-
-            # then, compose it. 3 tries, in case Wand acts funny.
-            for _ in range(3):
-                try:
-                    self.compose(result)
-                    return
-                except AkariTooBigError:
-                    utils.logger.info('Composed an animation that is too big.')
-                    # a retry would generate the same gif with the same
-                    # problem, so don't do that. go for the next result.
-                    break
-                except AkariWandIsRetardedError:
-                    # this, we want to retry it
-                    utils.logger.info('Wand failed to save the animation.')
+            filename = images.get(self._render_name(result))
+            if filename:
+                utils.logger.info('Returning cached render "%s"', filename)
+                self.filename = filename
+                self.caption = self._caption_text()
+                return
+
+        # download several results at once, so a slow or broken result
+        # doesn't delay the rest. then try them in order.
+        downloads = Prefetch(
+            results, workers=akari_settings.prefetch_results or 3)
+        try:
+            for result in downloads:
+                # compose it. 3 tries, in case Wand acts funny.
+                for _ in range(3):
+                    try:
+                        if composer:
+                            akari = composer(self, result)
+                            self.filename = akari.filename
+                            self.caption = akari.caption
+                        else:
+                            self.compose(result)
+                        return
+                    except AkariTooBigError:
+                        utils.logger.info('Composed an animation that is '
+                                          'too big.')
+                        # a retry would generate the same gif with the same
+                        # problem, so don't do that. go for the next result.
+                        break
+                    except AkariBrokenImageError as exc:
+                        utils.logger.info('%s', exc)
+                        break
+                    except AkariWandIsRetardedError:
+                        # this, we want to retry it
+                        utils.logger.info('Wand failed to save the '
+                                          'animation.')
+        finally:
+            # we have got an image, or we have given up. either way, the
+            # downloads that are still going on are not needed anymore.
+            downloads.cancel()
 
         raise AkariComposingError('Could not generate an image.')
 
@@ -99,120 +161,190 @@ class Akari(object):
             else:
                 frames = [frames]
 
-            akari_frames = [Image(filename=x) for x in frames]
-            width, height = akari_frames[0].width, akari_frames[0].height
+            # all masks premultiplied in a single memory mapped array
+            akari_frames = layers.load_masks(frames)
+            height, width = akari_frames.shape[1:3]
         else:
             akari_frames = []
             width, height = 1600, 1200
 
         # cache all of this
-        cache.set('akari:frames', akari_frames)
+        cache.set('akari:masks', akari_frames)
         cache.set('akari:width', width)
         cache.set('akari:height', height)
 
     def compose(self, image):
         utils.logger.info('Starting to compose Akari...')
 
-        if 'akari:frames' not in cache:
-            # cache miss
-            utils.logger.warning('Akari frames were not warmed up!')
-            self.warmup()
-
-        akari_frames = cache.get('akari:frames')
-        self.width = cache.get('akari:width')
-        self.height = cache.get('akari:height')
+        akari_frames = cache.get('akari:masks')
+        self.width = cache.get('akari:width') // self.shrink
+        self.height = cache.get('akari:height') // self.shrink
 
-        if self.type == 'animation' and len(akari_frames) < 2:
-            # if we were asked to generate an animation but there's only one
-            # mask, then we're generating a still image
-            self.type = 'still'
-        elif self.type == 'still' and len(akari_frames) > 1:
+        if self.type == 'still' and len(akari_frames) > 1:
             # if we were asked to generate a still image and there are several
             # masks, use only the first one
-            akari_frames = [akari_frames[0]]
+            akari_frames = akari_frames[:1]
+        elif self.frame_step > 1 and len(akari_frames) > 2:
+            akari_frames = akari_frames[::self.frame_step]
+        if self.shrink > 1 and len(akari_frames):
+            akari_frames = self._shrunk_masks(akari_frames)
 
         # now, get the background image
         filename = image.filename
-        with Image(filename=filename) as original:
-            # if it's an animation, take only the first frame
-            if original.animation:
-                bg_img = Image(original.sequence[0])
-            else:
-                bg_img = Image(original)
+        # if it's an animation, read only the first frame
+        try:
+            bg_img = Image(filename=filename + '[0]')
+        except Exception:
+            # downloads are only checked by their headers, so the rest of the
+            # file may be broken. remove it so it's not used again.
+            images.remove(image.get_name('original'))
+            raise AkariBrokenImageError('Could not read "%s"' % filename)
         # remove the alpha channel, if any
         bg_img.alpha_channel = False
         # resize it
         bg_img.transform(resize='{}x{}^'.format(self.width, self.height))
         bg_img.crop(width=self.width, height=self.height, gravity='center')
 
+        background = layers.from_image(bg_img, 'RGB')
+        bg_img.close()
+
         if self.text:
-            # generate the drawing to be applied to each frame
-            if self.caption_type == 'seinfeld':
-                caption, drawing = self._caption_seinfeld()
-            elif self.caption_type == 'sanandreas':
-                caption, drawing = self._caption_sanandreas()
-            else:
-                caption, drawing = self._caption_akari()
+            caption, layer = self._caption_layer()
         else:
-            caption, drawing = '', None
-
-        result = Image()  # this will be the resulting image
-        for akari_frame in akari_frames:
-            # take the background image
-            this_frame = Image(bg_img)
-
-            # put akari on top of it
-            this_frame.composite(akari_frame, left=0, top=0)
+            caption, layer = '', None
 
-            if drawing:
-                # draw the caption on this frame
-                drawing(this_frame)
-
-            if len(akari_frames) == 1:
-                # we are done already
-                result = Image(this_frame)
-            else:
-                # add the frame to the result image
-                result.sequence.append(this_frame)
-                with result.sequence[-1]:
-                    result.sequence[-1].delay = 10
-            # remove this frame from memory (it's in the sequence already)
-            this_frame.close()
-        if not akari_frames:
+        # put akari on top of the background, all frames at once
+        if len(akari_frames):
+            frames = layers.blend(background, akari_frames)
+        else:
             # shortcut in case there's no mask
-            this_frame = Image(bg_img)
-            if drawing:
-                drawing(this_frame)
-            result = Image(this_frame)
-            this_frame.close()
+            frames = background[numpy.newaxis]
+        if layer is not None:
+            # put the caption on top of everything else
+            frames = layers.blend(frames, layer)
 
         # save the result
-        filename = image.get_path(self.type)
-        result.compression_quality = 100
-        result.save(filename=filename)
-
-        # destroy everything
-        if drawing:
-            drawing.destroy()
-        for frame in result.sequence:
-            frame.destroy()
-        result.close()
-        bg_img.close()
-
+        name = self._render_name(image)
         try:
-            # if the gif is too big, it has to be discarded. a new one
-            # will be generated using a different image this time.
-            if os.path.getsize(filename) > 3072 * 1024:
-                raise AkariTooBigError('Composed an animation that is too big')
+            with images.put(name) as path:
+                if len(frames) > 1:
+                    size = self._save_animation(frames, path)
+                else:
+                    with layers.to_image(frames[0]) as result:
+                        result.compression_quality = 100
+                        result.save(filename=path)
+                    size = os.path.getsize(path)
+
+                # if the gif is still too big, it has to be discarded. a new
+                # one will be generated using a different image this time.
+                if size > self.MAX_SIZE:
+                    raise AkariTooBigError('Composed an animation that is '
+                                           'too big')
         except FileNotFoundError:
             # sometimes Wand fails to save the animation, and does not even
             # raise an exception. retry in this case.
             raise AkariWandIsRetardedError('Wand failed to save the animation')
+        filename = images.path(name)
 
         utils.logger.info('Akari composed and saved as "%s"', filename)
         self.filename = filename
         self.caption = caption
 
+    def _save_animation(self, frames, filename):
+        """saves the frames as a gif that should fit in MAX_SIZE. the size is
+            estimated beforehand from a trial encode of a single frame, and
+            the number of frames, the palette or the resolution are reduced
+            accordingly, so the whole animation is only encoded once. returns
+            the size of the file"""
+        # leave some room, because the estimate is not exact
+        budget = self.MAX_SIZE * 0.9
+        # skipped masks make the rest last longer
+        delay = 10 * self.frame_step
+
+        quantized = gif.quantize(frames, colors=self.colors)
+        bpp = gif.bytes_per_pixel(quantized)
+        size = gif.estimate_size(quantized, bpp)
+
+        if size > budget * 2 and len(frames) > 2:
+            # way too big. half the frames, each one lasting twice as long
+            frames, quantized = frames[::2], quantized[::2]
+            delay *= 2
+            size = gif.estimate_size(quantized, bpp)
+
+        if size > budget / 0.85:
+            # the size is roughly proportional to the number of pixels
+            scale = (budget / size) ** 0.5
+            width, height = int(self.width * scale), int(self.height * scale)
+            utils.logger.info('Animation would take %d bytes, resizing it '
+                              'to %dx%d', size, width, height)
+            quantized = gif.quantize(layers.resize(frames, width, height),
+                                     colors=self.colors)
+        elif size > budget:
+            # a bit too big. one bit less per pixel will do
+            utils.logger.info('Animation would take %d bytes, using a '
+                              'smaller palette', size)
+            quantized = gif.quantize(frames, colors=self.colors // 2)
+
+        return gif.save(quantized, filename, delay=delay)
+
+    def _render_name(self, image):
+        """returns the name of the file where the result for this image is
+            stored. it depends on everything that changes the result, so a
+            file with this name can be returned as it is.
+            the text is drawn exactly as it is, so it's not normalized here;
+            texts coming from Twitter are already normalized by utils.clean"""
+        key = utils.make_key_id(image.hash, self.text, self.caption_type,
+                                self.masks or '', self.type,
+                                '%d:%d:%d' % (self.frame_step, self.shrink,
+                                              self.colors))
+        ext = 'gif' if self.type == 'animation' else 'jpg'
+        return 'render_%s.%s' % (key, ext)
+
+    def _shrunk_masks(self, akari_frames):
+        """returns the masks shrunk by self.shrink, which are computed once
+            for each type, frame step and shrink factor"""
+        key = (self.masks, self.type, self.frame_step, self.shrink)
+        shrunk = shrunk_masks.get(key)
+        if shrunk is None:
+            shrunk = layers.shrink(akari_frames, self.shrink)
+            shrunk_masks.set(key, shrunk)
+        return shrunk
+
+    def _caption_text(self):
+        """returns the text of the caption, without drawing it"""
+        if not self.text:
+            return ''
+        elif self.caption_type in ('seinfeld', 'sanandreas'):
+            return self.text
+        else:
+            return 'わぁい{0} あかり{0}大好き'.format(self.text)
+
+    def _caption_layer(self):
+        """returns the caption and a transparent layer with it drawn, which
+            is rendered only once for each text, caption type and size"""
+        key = (self.text, self.caption_type, self.width, self.height)
+        cached = caption_layers.get(key)
+        if cached:
+            return cached
+
+        if self.caption_type == 'seinfeld':
+            caption, drawing = self._caption_seinfeld()
+        elif self.caption_type == 'sanandreas':
+            caption, drawing = self._caption_sanandreas()
+        else:
+            caption, drawing = self._caption_akari()
+
+        with Image(width=self.width, height=self.height,
+                   background=Color('transparent')) as image:
+            drawing(image)
+            layer = layers.premultiply(layers.from_image(image))
+        drawing.destroy()
+        # a stack of one layer, so it can be put over every frame at once
+        layer = layer[numpy.newaxis]
+
+        caption_layers.set(key, (caption, layer))
+        return caption, layer
+
     # word of caution: 2nd parameter of textwrap.fill previously depended on
     # the font size, which in turn depended on image width. that was wrong;
     # the amount of letters that fit in every row *remains constant* no matter
@@ -221,7 +353,7 @@ class Akari(object):
     # depending on the image width.
 
     def _caption_akari(self):
-        caption = 'わぁい{0} あかり{0}大好き'.format(self.text)
+        caption = self._caption_text()
         drawing = Drawing()
         drawing.font = 'assets/fonts/rounded-mgenplus-1c-bold.ttf'
         drawing.font_size = self.width / 15
@@ -292,83 +424,45 @@ def akari_cron():
     except Exception:
         pass
 
+    from pending import pending
     from twitter import twitter
 
-    ids = []
-    # get a random line. will error out if there are none, which is okay.
-    with open('pending.txt', errors='replace') as file:
-        for line in file.read().splitlines():
-            id_, text = line.split(' ', 1)
-
-            # if the blacklist is enabled, ignore tweets that match it
-            blacklist = cfg('twitter:text_blacklist:re_list')
-            if any(x.search(text) for x in blacklist):
-                continue
+    # blacklisted tweets were already marked when they were stored
+    ids = pending.candidates()
 
-            # alright, this tweet is a candidate
-            ids.append(id_)
-
-    # this function generates a score for each tweet
-    def score(status):
-        favs = status.favorite_count
-        rts = status.retweet_count
-        followers = status.user.followers_count
-        if (followers == 0 or  # avoid division by zero later on
-                status.user.protected):  # don't post from protected users
-            return -1
-
-        # decay coefficient. promotes newer tweets to compensate for the
-        # lower amount of favs they have received (fewer people have seen
-        # them, in theory)
-        diff = (datetime.utcnow() - status.created_at).total_seconds()
-        score = utils.decay(diff, cfg('twitter:cron_interval:int') * 60, 1.5)
-        score *= (favs + rts * 2) / followers
-
-        # apply penalties. some tweets carry a penalty but are not removed
-        # right away, in case there isn't anything better.
-        # at least 80% of letters in the status must be /a-zA-Z/
-        clean_text = utils.clean(status.text,
-                                 urls=True, replies=True, rts=True)
-        meat = sum(c in string.ascii_letters for c in clean_text) or -1
-        # also, get the author's lang and filter him if it's not in the wl
-        lang_wl = cfg('twitter:cron_lang_whitelist:list')
-        # filter quoted tweets
-        filter_quotes = cfg('twitter:cron_filter_quotes:bool')
-        if ((lang_wl and status.user.lang not in lang_wl) or
-                (filter_quotes and status.is_quote_status) or
-                meat / len(clean_text) < 0.8 or
-                followers < (followers_median * 1.5) or
-                favs < favs_median):
-            score /= 10
-
-        return score
-
-    # 100 at a time is the max statuses_lookup() can do.
-    statuses = []
-    for i in range(0, len(ids), 100):
-        group = ids[i:i + 100]
-        statuses.extend(tuple(twitter.api.statuses_lookup(group)))
-    followers_median = statistics.median(status.user.followers_count
-                                         for status in statuses)
-    favs_median = statistics.median(status.favorite_count
-                                    for status in statuses
-                                    if status.favorite_count > 0)
-    statuses.sort(key=score, reverse=True)
+    # the features of each group of statuses are extracted while the rest
+    # of them are still being looked up
+    scorer = Scorer(interval=cfg('twitter:cron_interval:int') * 60,
+                    lang_whitelist=cfg('twitter:cron_lang_whitelist:list'),
+                    filter_quotes=cfg('twitter:cron_filter_quotes:bool'))
+    workers = cfg('twitter:lookup_threads:int') or 4
+    for group in twitter.lookup_statuses(ids, workers=workers):
+        scorer.add(group)
+    statuses = scorer.top(10)
 
     # try to generate an image for the first status. if that fails, keep
     # trying with the next one until you have succeeded or until you have
-    # run out of attempts.
-    for status in statuses[:10]:
-        try:
-            caption = utils.clean(status.text,
-                                  urls=True, replies=True, rts=True)
-            utils.logger.info('Posting "%s" from %s',
-                              caption, twitter.status_to_url(status))
-            akari = Akari(caption, type='animation', shuffle_results=False)
-            break
-        except Exception:
-            utils.logger.exception('Error generating a caption.')
-            continue
+    # run out of attempts. meanwhile, the images of the next few statuses
+    # are searched and downloaded, so a failure doesn't cost a whole search.
+    captions = [utils.clean_status(status, urls=True, replies=True, rts=True)
+                for status in statuses]
+    lookahead = Lookahead(captions,
+                          ahead=cfg('akari:lookahead_statuses:int') or 2,
+                          limit=cfg('akari:limit_results:int') or None)
+    try:
+        for i, (status, caption) in enumerate(zip(statuses, captions)):
+            lookahead.advance(i)
+            try:
+                utils.logger.info('Posting "%s" from %s',
+                                  caption, twitter.status_to_url(status))
+                akari = Akari(caption, type='animation',
+                              shuffle_results=False)
+                break
+            except Exception:
+                utils.logger.exception('Error generating a caption.')
+                continue
+    finally:
+        lookahead.cancel()
 
     # this will crash it there's no caption available thus far, that's fine,
     # as the amount of tries has been exceeded and there was nothing left to do
@@ -378,9 +472,8 @@ def akari_cron():
     else:
         twitter.post(media=akari.filename)
 
-    # if a new caption has been successfully published, empty the file
-    with open('pending.txt', 'w'):
-        pass
+    # if a new caption has been successfully published, start over
+    pending.clear()
 
 
 def akari_cron_override(text):
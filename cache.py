@@ -1,3 +1,8 @@
+from collections import OrderedDict
+import threading
+import time
+
+
 class Cache(object):
     """a simple kv cache for some stuff that I don't mind losing upon
         restarts"""
@@ -16,5 +21,46 @@ class Cache(object):
         return key in self.cache
 
 
+class LRUCache(Cache):
+    """like Cache, but it only keeps the maxsize most recently used keys.
+        if ttl is given, keys also expire after ttl seconds. thread safe"""
+    _missing = object()
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.cache = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self.lock:
+            try:
+                value, expires = self.cache[key]
+            except KeyError:
+                return self._missing
+            if expires is not None and expires < time.time():
+                del self.cache[key]
+                return self._missing
+            self.cache.move_to_end(key)
+            return value
+
+    def get(self, key):
+        value = self._lookup(key)
+        return None if value is self._missing else value
+
+    def set(self, key, value, ttl=None):
+        """ttl: overrides the ttl of the cache for this key"""
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.cache[key] = (value, expires)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not self._missing
+
+
 # this is a global, shared instance of Cache to be used by anybody
 cache = Cache()
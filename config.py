@@ -1,38 +1,177 @@
 import configparser
+import logging
+import os
 import re
 import sys
-from time import sleep
+import threading
+from time import monotonic, sleep
 
 from cache import cache
+from matcher import DomainSet, Matcher
 
 
 class ConfigCacheMissError(Exception):
     pass
 
 
+# every setting that is read through settings(), and its type
+SCHEMA = {
+    'akari': {
+        'caption_type': 'str',
+        'frames': 'str',
+        'limit_results': 'int',
+        'lookahead_statuses': 'int',
+        'prefetch_results': 'int',
+    },
+    'image_search': {
+        'banned_sources': 'domains',
+        'override': 'list',
+        'store_size': 'int',
+        'user_agent': 'str',
+    },
+    'tasks': {
+        'follow_last_post_days': 'int',
+        'follow_max_friends': 'int',
+        'follow_min_followers': 'int',
+        'follow_only_lang': 'list',
+    },
+    'twitter': {
+        'cron_filter_quotes': 'bool',
+        'cron_interval': 'int',
+        'cron_lang_whitelist': 'list',
+        'delete_triggers': 'matcher',
+        'error_image': 'str',
+        'lookup_threads': 'int',
+        'mentions_interval': 'int',
+        'no_results_image': 'str',
+        'process_threads': 'int',
+        'render_memory': 'int',
+        'render_target': 'int',
+        'render_workers': 'int',
+        'request_blacklist': 'matcher',
+        'request_deadline': 'int',
+        'sources_whitelist': 'list',
+        'text_blacklist': 'matcher',
+        'text_in_status': 'bool',
+        'user_images': 'bool',
+        'user_requests': 'bool',
+    },
+}
+
+
+class Settings(object):
+    """read only values, accessed as attributes. settings that are not in
+        the file are None"""
+
+    def __init__(self, values):
+        object.__setattr__(self, '_values', values)
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            # don't make pickle and friends think there's something here
+            raise AttributeError(key)
+        try:
+            return self._values[key]
+        except KeyError:
+            raise AttributeError('No such setting: %s' % key)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Settings are read only')
+
+
 class Config(object):
+    # secs between checks for changes in the file
+    RELOAD_INTERVAL = 5
+
     def __init__(self, filename, cached=True, retry=5):
         """cached: use cache
             retry: how many times to retry opening the config file if it's
                 locked. there's a delay of 1 second between retries"""
-        self.config = configparser.ConfigParser()
         self.filename = filename
         self.cached = cached
         self.retry = retry
+        self.lock = threading.Lock()
+        self._load()
 
+    def _load(self):
+        """reads the file and converts the settings. if anything fails, the
+            settings that were there before are kept"""
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError:
+            mtime = None
+        self.checked = monotonic()
+
+        config = configparser.ConfigParser()
         for _ in range(self.retry):
             try:
                 with open(self.filename) as fp:
-                    self.config.read_file(fp)
-                return
+                    config.read_file(fp)
+                break
             except FileNotFoundError:
                 # pretend it's an empty file
-                return
+                break
             except OSError:
                 # file locked, try again in 1 second
                 sleep(1)
-        raise OSError("I couldn't open the config file after %d retries" %
-                      self.retry)
+        else:
+            raise OSError("I couldn't open the config file after %d "
+                          'retries' % self.retry)
+
+        old_config, self.config = getattr(self, 'config', None), config
+        try:
+            self.snapshot = self._make_snapshot()
+        except Exception:
+            self.config = old_config
+            raise
+        self.mtime = mtime
+
+    def _make_snapshot(self):
+        """converts every setting in the schema to its type, once"""
+        sections = {}
+        for section, keys in SCHEMA.items():
+            values = {}
+            for key, type_ in keys.items():
+                try:
+                    value = self._convert(section, key, type_)
+                except KeyError:
+                    value = None
+                except (ValueError, re.error) as exc:
+                    # a bad setting must not take everything else down with
+                    # it, so it's left out, as if it wasn't there
+                    logging.getLogger('akari_endlosung').warning(
+                        'Ignoring bad setting %s:%s: %s', section, key, exc)
+                    value = None
+                if isinstance(value, list):
+                    value = tuple(value)
+                values[key] = value
+            sections[section] = Settings(values)
+        return Settings(sections)
+
+    def settings(self):
+        """returns the settings. if the file has changed, it's read again
+            and new settings are returned. the old ones don't change"""
+        if monotonic() - self.checked > self.RELOAD_INTERVAL:
+            with self.lock:
+                self.checked = monotonic()
+                try:
+                    mtime = os.stat(self.filename).st_mtime_ns
+                except OSError:
+                    mtime = None
+                if mtime != self.mtime:
+                    try:
+                        self._load()
+                    except Exception:
+                        # keep going with the old settings until it's fixed,
+                        # whatever is wrong with the new ones (such as a
+                        # regular expression that doesn't compile). this
+                        # mtime is not tried again
+                        self.mtime = mtime
+                        logging.getLogger('akari_endlosung').exception(
+                            'Error reloading the config file')
+                    else:
+                        self._clear_cache()
+        return self.snapshot
 
     def __enter__(self):
         return self
@@ -61,7 +200,12 @@ class Config(object):
             raise KeyError('No such option')
 
     def _get_bool(self, section, key):
-        return self.config.getboolean(section, key)
+        try:
+            return self.config.getboolean(section, key)
+        except configparser.NoSectionError:
+            raise KeyError('No such section')
+        except configparser.NoOptionError:
+            raise KeyError('No such option')
 
     def _to_int(self, value):
         return int(value)
@@ -78,6 +222,12 @@ class Config(object):
     def _to_re_list(self, value):
         return [re.compile(x, re.IGNORECASE) for x in self._to_list(value)]
 
+    def _to_matcher(self, value):
+        return Matcher(self._to_list(value))
+
+    def _to_domains(self, value):
+        return DomainSet(self._to_list(value))
+
     def _to_str(self, value):
         return value.strip()
 
@@ -87,48 +237,72 @@ class Config(object):
         else:
             return str(value)
 
-    def _cache_get(self, section, key):
+    @staticmethod
+    def _cache_key(section, key, type):
+        # the type is part of the key, because the same setting can be read
+        # as different types. the prefix keeps it apart from other things
+        # in the cache
+        return 'config:%s:%s:%s' % (section, key, type)
+
+    def _cache_get(self, section, key, type):
         if not self.cached:
             raise ConfigCacheMissError('caching is disabled')
 
-        ret = cache.get('%s:%s' % (section, key))
-        if not ret:
+        # falsy values such as 0 or [] are cached too
+        cache_key = self._cache_key(section, key, type)
+        if cache_key not in cache:
             raise ConfigCacheMissError('key not in cache')
-        return ret
+        return cache.get(cache_key)
 
-    def _cache_set(self, section, key, value):
+    def _cache_set(self, section, key, type, value):
         if self.cached:
-            return cache.set('%s:%s' % (section, key), value)
+            return cache.set(self._cache_key(section, key, type), value)
+
+    def _clear_cache(self):
+        # other threads add things to the cache while this runs, so go
+        # through a copy of the keys
+        for cache_key in list(cache.cache):
+            if isinstance(cache_key, str) and cache_key.startswith('config:'):
+                cache.cache.pop(cache_key, None)
 
     def set(self, section, key, value):
         if not self.config.has_section(section):
             self.config.add_section(section)
         self.config.set(section, key, self._to_config_str(value))
         self._save()
+        self._clear_cache()
+        self.snapshot = self._make_snapshot()
+
+    def _convert(self, section, key, type):
+        if type in (int, 'int'):
+            return self._to_int(self._get(section, key))
+        elif type in (list, 'list'):
+            return self._to_list(self._get(section, key))
+        elif type == 're_list':
+            return self._to_re_list(self._get(section, key))
+        elif type == 'int_list':
+            return self._to_int_list(self._get(section, key))
+        elif type == 'matcher':
+            return self._to_matcher(self._get(section, key))
+        elif type == 'domains':
+            return self._to_domains(self._get(section, key))
+        elif type in (str, 'str'):
+            return self._to_str(self._get(section, key))
+        elif type in (bool, 'bool'):
+            return self._get_bool(section, key)
+        else:
+            raise ValueError('Unknown type: %s' % type)
 
     def get(self, section, key, type=str, default=None):
         try:
-            return self._cache_get(section, key)
+            return self._cache_get(section, key, type)
         except ConfigCacheMissError:
             try:
-                if type in (int, 'int'):
-                    ret = self._to_int(self._get(section, key))
-                elif type in (list, 'list'):
-                    ret = self._to_list(self._get(section, key))
-                elif type == 're_list':
-                    ret = self._to_re_list(self._get(section, key))
-                elif type == 'int_list':
-                    ret = self._to_int_list(self._get(section, key))
-                elif type in (str, 'str'):
-                    ret = self._to_str(self._get(section, key))
-                elif type in (bool, 'bool'):
-                    ret = self._get_bool(section, key)
-                else:
-                    raise ValueError('Unknown type: %s' % type)
-                self._cache_set(section, key, ret)
-                return ret
+                ret = self._convert(section, key, type)
             except KeyError:
                 return default
+            self._cache_set(section, key, type, ret)
+            return ret
 
 
 try:
@@ -152,6 +326,13 @@ def cfg(key, config_handle=config):
         raise ValueError('Malformed key: "%s"' % key)
 
 
+def settings(config_handle=config):
+    """returns the typed settings of SCHEMA, as in
+        settings().twitter.cron_interval. they are converted when the file
+        is read, so this is cheap enough to call anywhere"""
+    return config_handle.settings()
+
+
 def cfgs(key, value, config_handle=config):
     """small shorthand method for config.set. key is section:key; type is
         always str"""
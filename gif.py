@@ -0,0 +1,111 @@
+import os
+
+import numpy
+from wand.image import Image
+
+import layers
+
+
+# colours are looked up in the palette using their 5 most significant bits
+LUT_BITS = 5
+
+
+def make_palette(frames, colors=256):
+    """quantizes a sample of all frames at once and returns the resulting
+        colours as a (colors, 3) array, to be shared by every frame"""
+    sample = frames[:, ::4, ::4]
+    sample = sample.reshape(-1, sample.shape[2], 3)  # one frame under another
+    with layers.to_image(sample) as image:
+        image.quantize(colors, 'undefined', 0, False, False)
+        pixels = layers.from_image(image, 'RGB')
+    return numpy.unique(pixels.reshape(-1, 3), axis=0)
+
+
+def make_lut(palette):
+    """returns the closest colour of the palette for every possible colour,
+        with LUT_BITS bits per channel"""
+    shift = 8 - LUT_BITS
+    steps = numpy.arange(1 << LUT_BITS, dtype=numpy.int32) << shift
+    steps += (1 << shift) >> 1  # the centre of each bucket
+    r, g, b = numpy.meshgrid(steps, steps, steps, indexing='ij')
+    colors = numpy.stack((r.ravel(), g.ravel(), b.ravel()), axis=1)
+
+    # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, and |c|^2 doesn't change the result
+    colors = colors.astype(numpy.float32)
+    palette = palette.astype(numpy.float32)
+    distances = (palette * palette).sum(axis=1) - 2 * colors.dot(palette.T)
+    lut = numpy.argmin(distances, axis=1)
+    return palette.astype(numpy.uint8)[lut]
+
+
+def remap(frames, lut):
+    """replaces every pixel with its closest colour of the palette"""
+    shift = 8 - LUT_BITS
+    index = (frames[..., 0] >> shift).astype(numpy.int32) << (2 * LUT_BITS)
+    index |= (frames[..., 1] >> shift).astype(numpy.int32) << LUT_BITS
+    index |= frames[..., 2] >> shift
+    return lut[index]
+
+
+def changed_box(previous, frame):
+    """returns the smallest (left, top, right, bottom) box that contains all
+        pixels that differ between two frames"""
+    changed = numpy.any(previous != frame, axis=2)
+    rows = numpy.flatnonzero(changed.any(axis=1))
+    cols = numpy.flatnonzero(changed.any(axis=0))
+    if not len(rows):
+        # gifs can't have empty frames, so repeat a single pixel
+        return 0, 0, 1, 1
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def quantize(frames, colors=256):
+    """maps all frames to a single palette of the given number of colours"""
+    return remap(frames, make_lut(make_palette(frames, colors)))
+
+
+def bytes_per_pixel(frames):
+    """encodes only the first of the quantized frames and returns how many
+        bytes each pixel took, to estimate the size of the whole gif"""
+    height, width = frames.shape[1:3]
+    with layers.to_image(frames[0]) as image:
+        image.format = 'gif'
+        return len(image.make_blob()) / (width * height)
+
+
+def estimate_size(frames, bpp):
+    """estimates the size of the gif of the quantized frames, given the bytes
+        per pixel returned by bytes_per_pixel()"""
+    height, width = frames.shape[1:3]
+    area = width * height
+    for previous, frame in zip(frames, frames[1:]):
+        left, top, right, bottom = changed_box(previous, frame)
+        area += (right - left) * (bottom - top)
+    return int(area * bpp)
+
+
+def save(frames, filename, delay=10):
+    """saves an array of quantized frames as an animated gif. only the part
+        of each frame that changed from the previous one is stored. returns
+        the size of the file"""
+    height, width = frames.shape[1:3]
+
+    with Image() as result:
+        previous = None
+        for frame in frames:
+            if previous is None:
+                left, top, right, bottom = 0, 0, width, height
+            else:
+                left, top, right, bottom = changed_box(previous, frame)
+            previous = frame
+
+            with layers.to_image(frame[top:bottom, left:right]) as image:
+                image.page = (width, height, left, top)
+                result.sequence.append(image)
+            with result.sequence[-1]:
+                result.sequence[-1].delay = delay
+
+        result.format = 'gif'
+        result.save(filename=filename)
+
+    return os.path.getsize(filename)
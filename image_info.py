@@ -0,0 +1,79 @@
+import struct
+
+
+class ImageInfoError(ValueError):
+    pass
+
+
+# jpeg markers that start a frame and carry the size of the image
+JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                    0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+
+def sniff(data):
+    """figures out the format and size of an image from its first bytes,
+        without decoding it. returns (format, width, height). width and
+        height are None if more bytes are needed to find them. raises
+        ImageInfoError if the data does not look like an image"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return ('jpeg',) + _jpeg_size(data)
+    elif data.startswith(b'\x89PNG\r\n\x1a\n'):
+        if len(data) < 24:
+            return 'png', None, None
+        return ('png',) + struct.unpack('>II', data[16:24])
+    elif data[:6] in (b'GIF87a', b'GIF89a'):
+        if len(data) < 10:
+            return 'gif', None, None
+        return ('gif',) + struct.unpack('<HH', data[6:10])
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return ('webp',) + _webp_size(data)
+    elif data[:2] == b'BM':
+        if len(data) < 26:
+            return 'bmp', None, None
+        width, height = struct.unpack('<ii', data[18:26])
+        return 'bmp', width, abs(height)
+    elif len(data) < 12:
+        # too short to tell
+        return None, None, None
+    raise ImageInfoError('Unknown image format')
+
+
+def _jpeg_size(data):
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xff:
+            raise ImageInfoError('Corrupt jpeg')
+        marker = data[pos + 1]
+        if marker == 0xff:
+            # padding
+            pos += 1
+            continue
+        if marker == 0xd8 or 0xd0 <= marker <= 0xd7:
+            # markers without a length
+            pos += 2
+            continue
+        length, = struct.unpack('>H', data[pos + 2:pos + 4])
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                break
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None, None
+
+
+def _webp_size(data):
+    if len(data) < 30:
+        return None, None
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3fff, height & 0x3fff
+    elif chunk == b'VP8L':
+        bits, = struct.unpack('<I', data[21:25])
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    raise ImageInfoError('Corrupt webp')
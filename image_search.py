@@ -1,15 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import hashlib
 import json
-import os
 import re
 import socket
+import threading
 import urllib
 
 from bs4 import BeautifulSoup
 import requests
-from wand.image import Image
 
-from config import cfg
+from config import cfg, settings
+import image_info
+from store import images
 import utils
 
 
@@ -21,6 +24,7 @@ class ImageSearchNoResultsError(Exception):
     pass
 
 
+@utils.coalesce('google_image_search')
 def google_image_search(text):
     utils.logger.info('Starting Google image search: "%s"', text)
 
@@ -67,24 +71,40 @@ def google_image_search(text):
 regex_remove_not = re.compile(r'(\W)-')
 
 
-@utils.memoize('image_search', timeout=60 * 60 * 8)
-def image_search(text):
+def normalize_query(text):
+    """returns the text as it is sent to the search engine. texts that
+        only differ in case or whitespace end up as the same query, so they
+        share the same cached and in-flight searches"""
     # remove leading hyphens from words
     text = regex_remove_not.sub(r'\1', text)
-    results = google_image_search(text)
+    return ' '.join(text.lower().split())
+
+
+def image_search(text):
+    text = normalize_query(text)
+    results = _image_search(text)
 
     if not results:
         raise ImageSearchNoResultsError('No results found for "%s"' % text)
 
+    return [ImageSearchResult(image_url, source_url, text)
+            for image_url, source_url in results]
+
+
+@utils.memoize('image_search', timeout=60 * 60 * 8,
+               negative_timeout=60 * 30)
+def _image_search(text):
+    """returns the (image url, source url) of every result that does not
+        come from a banned source"""
     res = []
-    for image_url, source_url in results:
+    banned_sources = settings().image_search.banned_sources
+    for image_url, source_url in google_image_search(text):
         # check if the source is banned and, in that case, ignore it
-        banned_sources = cfg('image_search:banned_sources:list')
-        if (any(x in source_url for x in banned_sources) or
-                any(x in image_url for x in banned_sources)):
+        if banned_sources and (banned_sources.match(source_url) or
+                               banned_sources.match(image_url)):
             continue
 
-        res.append(ImageSearchResult(image_url, source_url, text))
+        res.append((image_url, source_url))
 
     return res
 
@@ -93,6 +113,119 @@ class ImageSearchResultError(Exception):
     pass
 
 
+# all downloads go through this session, so connections are reused
+session = requests.Session()
+for prefix in ('http://', 'https://'):
+    session.mount(prefix, requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+# images with more pixels or bytes than this are not downloaded
+MAX_PIXELS = 40 * 1000 * 1000
+MAX_DOWNLOAD_SIZE = 25 * 1024 * 1024
+
+# besides image/*, these are accepted because some servers send them
+ALLOWED_CONTENT_TYPES = ('application/octet-stream', 'binary/octet-stream')
+
+# max number of images downloaded at once from the same host
+MAX_DOWNLOADS_PER_HOST = 2
+# host -> [semaphore, number of downloads waiting for it or holding it]
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def host_slot(url):
+    """limits the downloads from the host of this url. the semaphore of a
+        host is only forgotten when nobody is using it, or the limit would
+        be lifted for the downloads that are still going on"""
+    host = urllib.parse.urlsplit(url).hostname
+    with host_slots_lock:
+        slot = host_slots.setdefault(
+            host, [threading.BoundedSemaphore(MAX_DOWNLOADS_PER_HOST), 0])
+        slot[1] += 1
+    try:
+        with slot[0]:
+            yield
+    finally:
+        with host_slots_lock:
+            slot[1] -= 1
+            if not slot[1]:
+                del host_slots[host]
+
+
+class Prefetch(object):
+    """downloads a list of results in the background, several at a time.
+        iterating over it returns the results that were downloaded
+        successfully, in their original order, as soon as each of them is
+        ready. cancel() stops all downloads that are still pending"""
+
+    def __init__(self, results, workers=3):
+        self.results = results
+        self.cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = [executor.submit(result.download, self.cancelled)
+                        for result in results]
+        # the executor is not needed anymore, but the downloads go on
+        executor.shutdown(wait=False)
+
+    def __iter__(self):
+        for result, future in zip(self.results, self.futures):
+            try:
+                future.result()
+            except ImageSearchResultError as exc:
+                utils.logger.info('Error downloading this result: %s', exc)
+                continue
+            yield result
+
+    def cancel(self):
+        self.cancelled.set()
+        for future in self.futures:
+            future.cancel()
+
+
+class Lookahead(object):
+    """searches and downloads the images of a list of texts in the background,
+        a few texts ahead of the one that is being used right now, so if it
+        fails, the next one is ready to go. the searches are memoized and the
+        downloads end up in the store, so they are picked up from there.
+        cancel() stops everything that is still going on"""
+
+    def __init__(self, texts, ahead=2, limit=None):
+        self.texts = texts
+        self.ahead = ahead
+        self.limit = limit
+        self.cancelled = threading.Event()
+        self.futures = {}
+        self.executor = ThreadPoolExecutor(max_workers=max(ahead, 1))
+
+    def advance(self, i):
+        """texts[i] is being used now. starts the ones after it"""
+        for j in range(i + 1, min(i + 1 + self.ahead, len(self.texts))):
+            if j not in self.futures and not self.cancelled.is_set():
+                self.futures[j] = self.executor.submit(self._warm,
+                                                       self.texts[j])
+
+    def _warm(self, text):
+        try:
+            results = image_search(text)
+        except Exception as exc:
+            utils.logger.info('Lookahead search failed: %s', exc)
+            return
+
+        for result in results[:self.limit]:
+            if self.cancelled.is_set():
+                return
+            try:
+                result.download(self.cancelled)
+            except ImageSearchResultError as exc:
+                utils.logger.info('Lookahead download failed: %s', exc)
+
+    def cancel(self):
+        self.cancelled.set()
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
 class ImageSearchResult(object):
     def __init__(self, image_url, source_url, text):
         self.image_url = image_url
@@ -101,58 +234,112 @@ class ImageSearchResult(object):
         self.hash = hashlib.md5(image_url.encode('utf-8')).hexdigest()
         self.filename = None  # will be populated after calling .download()
 
-    def download(self):
-        self.filename = self.get_path('original')
-        if os.path.isfile(self.filename):
+    def download(self, cancelled=None):
+        """cancelled: an Event that aborts the download when it's set"""
+        name = self.get_name('original')
+        self.filename = images.get(name)
+        if self.filename:
             utils.logger.info('Returning cached file "%s".', self.image_url)
             return
 
+        with host_slot(self.image_url):
+            if cancelled and cancelled.is_set():
+                raise ImageSearchResultError('Cancelled')
+            self._download(name, cancelled)
+
+        self.filename = images.path(name)
+        utils.logger.info('Complete')
+
+    def _download(self, name, cancelled):
         try:
             utils.logger.info('Downloading image "%s" from "%s"',
                               self.image_url, self.source_url)
             headers = {'Accept': '*/*',
-                       'User-Agent': cfg('image_search:user_agent'),
+                       'User-Agent': settings().image_search.user_agent,
                        'Referer': self.source_url}
-            response = requests.get(self.image_url, headers=headers, timeout=5)
+            # the body is read bit by bit, so it is never held in memory as
+            # a whole, and downloads can be aborted at any point.
+            response = session.get(self.image_url, headers=headers,
+                                   timeout=5, stream=True)
         except (requests.exceptions.RequestException, socket.timeout):
             # if the download times out, try with the next result
             raise ImageSearchResultError('Timed out')
 
-        # if the download fails (404, ...), try with the next result
-        if response.status_code != requests.codes.ok:
-            raise ImageSearchResultError('Download of image failed')
-
-        # store the image
-        utils.logger.info('Saving image to "%s"', self.filename)
-        with open(self.filename, 'wb') as handle:
-            for block in response.iter_content(1024 * 1024):
-                if not block:
-                    break
-                handle.write(block)
+        with contextlib.closing(response):
+            # if the download fails (404, ...), try with the next result
+            if response.status_code != requests.codes.ok:
+                raise ImageSearchResultError('Download of image failed')
+
+            # don't even start if the headers say it won't be any good
+            content_type = response.headers.get('Content-Type', '')
+            content_type = content_type.split(';')[0].strip().lower()
+            if (content_type and not content_type.startswith('image/') and
+                    content_type not in ALLOWED_CONTENT_TYPES):
+                raise ImageSearchResultError('Not an image (%s)' %
+                                             content_type)
+            try:
+                length = int(response.headers['Content-Length'])
+            except (KeyError, ValueError):
+                length = None
+            if length and length > MAX_DOWNLOAD_SIZE:
+                raise ImageSearchResultError('Image too big (%d bytes)' %
+                                             length)
+
+            # store the image. if anything goes wrong, nothing is stored.
+            utils.logger.info('Saving image to "%s"', images.path(name))
+            with images.put(name) as path:
+                with open(path, 'wb') as handle:
+                    self._save(response, handle, cancelled)
 
         # and a metadata file to know where it came from
-        metafile = self.get_path('meta')
-        with open(metafile, 'w') as fp:
-            print('url:    %s' % self.image_url, file=fp)
-            print('source: %s' % self.source_url, file=fp)
-            print('query:  %s' % self.text, file=fp)
-
-        # check the size of the image before loading it into memory
-        if os.stat(self.filename).st_size > 25 * 1024 * 1024:
-            raise ImageSearchResultError('Image too big')
-
-        # try to get Wand to load it as an image. if that doesn't work, raise
-        # an exception so that we try with the next result
-        try:
-            image = Image(filename=self.filename)
-        except Exception:
+        with images.put(self.get_name('meta')) as path:
+            with open(path, 'w') as fp:
+                print('url:    %s' % self.image_url, file=fp)
+                print('source: %s' % self.source_url, file=fp)
+                print('query:  %s' % self.text, file=fp)
+
+    def _save(self, response, handle, cancelled):
+        # the first bytes are checked before anything is written, so things
+        # that are not images, or are too big to handle, are rejected
+        # without having to decode them.
+        header = b''
+        size = 0
+        blocks = response.iter_content(64 * 1024)
+        while True:
+            try:
+                block = next(blocks, None)
+            except (requests.exceptions.RequestException, socket.timeout):
+                raise ImageSearchResultError('Timed out')
+            if not block:
+                break
+            if cancelled and cancelled.is_set():
+                raise ImageSearchResultError('Cancelled')
+
+            # Content-Length may be missing or lie, so keep count
+            size += len(block)
+            if size > MAX_DOWNLOAD_SIZE:
+                raise ImageSearchResultError('Image too big')
+
+            if header is not None:
+                header += block
+                try:
+                    format_, width, height = image_info.sniff(header)
+                except image_info.ImageInfoError:
+                    raise ImageSearchResultError('Not an image')
+                if width is not None:
+                    if width * height > MAX_PIXELS:
+                        raise ImageSearchResultError('Image too big (%dx%d)' %
+                                                     (width, height))
+                    header = None  # it's okay
+                elif len(header) > 1024 * 1024:
+                    raise ImageSearchResultError('Size of image not found')
+
+            handle.write(block)
+
+        if header is not None:
             raise ImageSearchResultError('Not an image')
-        else:
-            image.destroy()
-
-        utils.logger.info('Complete')
 
-    def get_path(self, kind):
+    def get_name(self, kind):
         if kind == 'meta':
             ext = 'txt'
         elif kind == 'animation':
@@ -160,4 +347,4 @@ class ImageSearchResult(object):
         else:
             ext = 'jpg'
 
-        return 'images/image_%s_%s.%s' % (self.hash, kind, ext)
+        return 'image_%s_%s.%s' % (self.hash, kind, ext)
@@ -0,0 +1,49 @@
+import time
+
+import utils
+
+
+class Ladder(object):
+    """decides how cheap animations have to be, given how much pressure the
+        system is under. pressure is 1 when the system is at its limit.
+        every step is cheaper than the one before, and the last one means
+        no rendering at all. it goes up one step at a time while the
+        pressure is over high, and down one step at a time while it is
+        under low. a step is held for a while before going down, so it
+        doesn't go back and forth all the time"""
+    STEPS = (
+        {},  # full quality
+        {'frame_step': 2},
+        {'frame_step': 2, 'shrink': 2},
+        {'frame_step': 2, 'shrink': 2, 'colors': 64},
+        {'type': 'still', 'shrink': 2},
+        None,  # too busy
+    )
+
+    def __init__(self, high=1.0, low=0.6, up_after=5, down_after=30):
+        self.high = high
+        self.low = low
+        self.up_after = up_after
+        self.down_after = down_after
+        self.step = 0
+        self.changed = 0
+
+    def update(self, pressure):
+        """returns the Akari kwargs of the current step, or None if nothing
+            should be rendered"""
+        now = time.time()
+        step = self.step
+        if (pressure > self.high and step < len(self.STEPS) - 1 and
+                now - self.changed > self.up_after):
+            step += 1
+        elif (pressure < self.low and step > 0 and
+                now - self.changed > self.down_after):
+            step -= 1
+
+        if step != self.step:
+            utils.logger.warning('Pressure is %.2f, going from step %d to '
+                                 'step %d', pressure, self.step, step)
+            self.step = step
+            self.changed = now
+
+        return self.STEPS[self.step]
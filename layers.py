@@ -0,0 +1,102 @@
+import hashlib
+import os
+import tempfile
+
+import numpy
+from wand.image import Image
+
+
+# layers are (frames, height, width, 4) uint8 arrays. the first three
+# channels are rgb already multiplied by the alpha, which is the fourth one,
+# so putting a layer over an image is just one multiply and one add.
+
+
+def premultiply(rgba):
+    """multiplies the rgb channels of an rgba array by its alpha"""
+    alpha = rgba[..., 3:].astype(numpy.uint16)
+    rgb = (rgba[..., :3] * alpha + 127) // 255
+    return numpy.concatenate((rgb.astype(numpy.uint8), rgba[..., 3:]),
+                             axis=-1)
+
+
+def from_image(image, format='RGBA'):
+    """returns the pixels of a Wand image as a (height, width, channels)
+        array"""
+    image.depth = 8
+    blob = image.make_blob(format)
+    return numpy.frombuffer(blob, dtype=numpy.uint8).reshape(
+        image.height, image.width, len(format))
+
+
+def to_image(array):
+    """returns a Wand image from a (height, width, 3) rgb array"""
+    height, width = array.shape[:2]
+    return Image(blob=numpy.ascontiguousarray(array).tobytes(), format='RGB',
+                 width=width, height=height, depth=8)
+
+
+def resize(frames, width, height):
+    """resizes a (frames, height, width, 3) array of rgb frames"""
+    resized = []
+    for frame in frames:
+        with to_image(frame) as image:
+            image.resize(width, height)
+            resized.append(from_image(image, 'RGB'))
+    return numpy.stack(resized)
+
+
+def shrink(array, factor):
+    """shrinks a stack of frames or layers by an integer factor, averaging
+        each square of factor x factor pixels. premultiplied layers can be
+        averaged as they are"""
+    if factor == 1:
+        return array
+    height, width = array.shape[-3] // factor, array.shape[-2] // factor
+    array = array[..., :height * factor, :width * factor, :]
+    array = array.reshape(array.shape[:-3] + (height, factor,
+                                              width, factor, array.shape[-1]))
+    summed = array.sum(axis=(-4, -2), dtype=numpy.uint32)
+    return ((summed + factor * factor // 2) //
+            (factor * factor)).astype(numpy.uint8)
+
+
+def blend(background, layers):
+    """puts each layer over the background. the background can be a single
+        (height, width, 3) image or a stack of them, and the result is one
+        rgb frame per layer, computed all at once"""
+    alpha = 255 - layers[..., 3:].astype(numpy.uint16)
+    frames = (background.astype(numpy.uint16) * alpha + 127) // 255
+    frames += layers[..., :3]
+    return frames.astype(numpy.uint8)
+
+
+def load_masks(filenames):
+    """decodes the masks into a single layer array. it is stored in a file
+        and memory mapped, so all processes that use the same masks share
+        one decoded copy of them instead of decoding them on their own"""
+    key = hashlib.md5()
+    for filename in filenames:
+        stat = os.stat(filename)
+        key.update(('%s:%d:%d\n' % (os.path.abspath(filename), stat.st_size,
+                                    stat.st_mtime_ns)).encode('utf-8'))
+    path = os.path.join(tempfile.gettempdir(),
+                        'akari_masks_%s.npy' % key.hexdigest())
+
+    try:
+        return numpy.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass  # not decoded yet
+
+    masks = []
+    for filename in filenames:
+        with Image(filename=filename) as image:
+            masks.append(premultiply(from_image(image)))
+    masks = numpy.stack(masks)
+
+    # write it somewhere else first, so nobody maps a half written file
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        numpy.save(fp, masks)
+    os.replace(tmp_path, path)
+
+    return numpy.load(path, mmap_mode='r')
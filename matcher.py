@@ -0,0 +1,71 @@
+import re
+from urllib.parse import urlsplit
+
+
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class Matcher(object):
+    """a list of regular expressions compiled into a single one, so a text
+        is checked against all of them in one pass. it's false if the list
+        is empty"""
+
+    def __init__(self, patterns, flags=re.IGNORECASE):
+        self.patterns = tuple(patterns)
+        self.regexes = [re.compile(x, flags) for x in self.patterns]
+        self.regex = None
+        # group numbers change once they're put together, and some things
+        # like global flags or repeated group names can't be put together
+        # at all. those have to be tried one by one
+        if not any(BACKREFERENCE.search(x) for x in self.patterns):
+            try:
+                self.regex = re.compile('|'.join('(?:%s)' % x
+                                                 for x in self.patterns),
+                                        flags)
+            except re.error:
+                pass
+
+    def search(self, text):
+        """returns the first match of any of the patterns, or None"""
+        if not self.patterns:
+            return None
+        elif self.regex:
+            return self.regex.search(text)
+        for regex in self.regexes:
+            match = regex.search(text)
+            if match:
+                return match
+        return None
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def __repr__(self):
+        return 'Matcher(%r)' % (self.patterns,)
+
+
+class DomainSet(object):
+    """a set of domains. a url matches if its host is one of them or a
+        subdomain of one of them"""
+
+    def __init__(self, domains):
+        self.domains = frozenset(x.lower().strip('.') for x in domains)
+
+    def match(self, url):
+        try:
+            host = urlsplit(url).hostname
+        except ValueError:
+            return False
+        if not host:
+            return False
+
+        # example.com matches www.example.com, but not badexample.com
+        parts = host.split('.')
+        return any('.'.join(parts[i:]) in self.domains
+                   for i in range(len(parts)))
+
+    def __bool__(self):
+        return bool(self.domains)
+
+    def __repr__(self):
+        return 'DomainSet(%r)' % (sorted(self.domains),)
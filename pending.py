@@ -0,0 +1,109 @@
+import calendar
+import contextlib
+import json
+import sqlite3
+import time
+
+from config import settings
+import utils
+
+
+class SQLiteStore(object):
+    """a table in pending.db, which is shared by several processes"""
+    SCHEMA = ''
+
+    def __init__(self, filename='pending.db'):
+        self.filename = filename
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # several processes use this at once, so wait for the others a bit
+        with contextlib.closing(sqlite3.connect(self.filename,
+                                                timeout=30)) as conn:
+            conn.executescript(self.SCHEMA)
+            with conn:  # commits at the end, or rolls back
+                yield conn
+
+
+class PendingStore(SQLiteStore):
+    """statuses from the home timeline that are candidates to be posted by
+        akari_cron(). whether a status is blacklisted is decided once, when
+        it is added, so picking the candidates is a single query.
+        their favs and retweets are not kept, since they change all the time
+        and akari_cron() looks them up anyway"""
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS statuses (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL,
+            blacklisted INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS statuses_candidates
+            ON statuses (blacklisted, id);
+    '''
+
+    def add(self, statuses):
+        """adds new statuses. those that are there already are ignored"""
+        blacklist = settings().twitter.text_blacklist
+        rows = []
+        for status in statuses:
+            text = utils.clean_status(status)
+            blacklisted = bool(blacklist and blacklist.search(text))
+            rows.append((status.id, text, int(blacklisted),
+                         calendar.timegm(status.created_at.utctimetuple())))
+
+        with self._connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO statuses VALUES '
+                             '(?, ?, ?, ?)', rows)
+
+    def candidates(self):
+        """returns the ids of all statuses that are not blacklisted"""
+        with self._connect() as conn:
+            return [id_ for id_, in conn.execute(
+                'SELECT id FROM statuses WHERE blacklisted = 0 ORDER BY id')]
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM statuses')
+
+
+class MentionQueue(SQLiteStore):
+    """mentions that have been retrieved but not answered yet. they are
+        saved before the last id seen is, so the ones that are waiting are
+        not lost if the mention worker is restarted"""
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS mentions (
+            id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            deadline REAL NOT NULL
+        );
+    '''
+
+    def add(self, statuses, deadline):
+        """deadline: time.time() after which they are not worth answering"""
+        rows = [(status.id, json.dumps(status._json), deadline)
+                for status in statuses]
+        with self._connect() as conn:
+            # the ones that were dropped because they were too late
+            conn.execute('DELETE FROM mentions WHERE deadline < ?',
+                         (time.time(),))
+            conn.executemany('INSERT OR IGNORE INTO mentions VALUES '
+                             '(?, ?, ?)', rows)
+
+    def waiting(self):
+        """returns (status json, deadline) for every mention that is still
+            worth answering, oldest first"""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM mentions WHERE deadline < ?',
+                         (time.time(),))
+            return [(json.loads(status), deadline) for status, deadline in
+                    conn.execute('SELECT status, deadline FROM mentions '
+                                 'ORDER BY id')]
+
+    def remove(self, id_):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM mentions WHERE id = ?', (id_,))
+
+
+pending = PendingStore()
+mentions = MentionQueue()
@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import os
+
+from akari import Akari
+from cache import cache
+
+
+class RenderQueueFullError(Exception):
+    pass
+
+
+class RenderTimeoutError(Exception):
+    pass
+
+
+def _render(text, **kwargs):
+    """runs inside a worker process. the frames are warmed up the first time
+        a worker gets a job, so forked workers don't share any ImageMagick
+        state with the parent"""
+    if 'akari:masks' not in cache:
+        Akari.warmup()
+    return Akari(text, **kwargs)
+
+
+def _compose(akari, image):
+    """runs inside a worker process. composes an image that has been
+        downloaded already, and returns the Akari with the result"""
+    if 'akari:masks' not in cache:
+        Akari.warmup()
+    akari.compose(image)
+    return akari
+
+
+def submit(executor, release, func, *args, **kwargs):
+    """submits a job to a pool of processes and returns its future.
+        release() is called once the worker is really done with the job, not
+        when we stop waiting for it: a job that is already running can't be
+        interrupted, so it keeps its worker busy until it finishes. if the
+        job can't be submitted, it's called right away.
+        whoever gives up on waiting should cancel() the future, which
+        cancels the job if it had not started yet"""
+    try:
+        future = executor.submit(func, *args, **kwargs)
+    except Exception:
+        release()
+        raise
+    future.add_done_callback(lambda _: release())
+    return future
+
+
+class RenderService(object):
+    """runs Akari in a pool of processes, so an asyncio loop can await the
+        result instead of being blocked while the image is composed.
+        workers:    number of processes (defaults to the number of cores)
+        queue_size: max number of renders waiting or running at once
+        timeout:    secs a render may take before giving up on it"""
+
+    def __init__(self, workers=None, queue_size=None, timeout=None,
+                 loop=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size or self.workers * 4
+        self.timeout = timeout or 60
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        # one slot per worker. waiters are woken up in order of arrival
+        self.slots = asyncio.Semaphore(self.workers)
+        # chat id -> [lock, number of renders of this chat in the queue]
+        self.chats = {}
+        self.pending = 0
+
+    async def render(self, chat_id, text, **kwargs):
+        if self.pending >= self.queue_size:
+            raise RenderQueueFullError('Too many renders in the queue')
+
+        self.pending += 1
+        chat = self.chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            # a chat can only have one render waiting for a slot at a time,
+            # so a chat that sends a lot of messages does not get ahead of
+            # the rest: its next render queues up behind everybody else's.
+            async with chat[0]:
+                return await self._submit(text, **kwargs)
+        finally:
+            self.pending -= 1
+            chat[1] -= 1
+            if not chat[1]:
+                del self.chats[chat_id]
+
+    async def _submit(self, text, **kwargs):
+        await self.slots.acquire()
+        future = submit(
+            self.executor,
+            lambda: self.loop.call_soon_threadsafe(self.slots.release),
+            _render, text, **kwargs)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise RenderTimeoutError('Render took more than %d seconds' %
+                                     self.timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,236 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from akari import Akari
+from ladder import Ladder
+from render import (_compose, RenderQueueFullError, RenderTimeoutError,
+                    submit)
+import utils
+
+
+def available_memory():
+    """returns the memory available in the system in bytes, or None if it
+        can't be known"""
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class Scheduler(object):
+    """runs func(thing, render) for every thing that is put in it, in a
+        pool of threads, in order of priority (lower goes first). things
+        that are still waiting when their deadline passes are dropped.
+        func does its network I/O in its thread, and calls render(text,
+        **kwargs) to make an Akari. its image is searched and downloaded in
+        the thread too, and only composing it happens in a pool of
+        processes. the number of renders that run at once depends on the
+        idle cores and the free memory, and it's checked again every few
+        seconds.
+        under pressure, animations are made cheaper step by step, as told
+        by a Ladder. the pressure comes from the number of things waiting,
+        the time renders are taking and the free memory.
+        io_workers:     number of threads
+        render_workers: max number of processes (defaults to the number of
+                        cores)
+        render_memory:  bytes of memory that a render may take
+        render_target:  secs that 95% of the renders should take at most"""
+    CAPACITY_INTERVAL = 10
+    # things waiting or rendering for each render that can run at once
+    QUEUE_TARGET = 4
+    # secs during which the time a render took is taken into account
+    DURATION_WINDOW = 120
+
+    def __init__(self, func, io_workers=8, render_workers=None,
+                 render_memory=300 * 1024 * 1024, render_target=30):
+        self.func = func
+        self.render_workers = render_workers or os.cpu_count() or 1
+        self.render_memory = render_memory
+        self.render_target = render_target
+        self.executor = ProcessPoolExecutor(max_workers=self.render_workers)
+        # the workers are forked when the first job is submitted. that has to
+        # happen before any thread is started, or a worker could inherit a
+        # lock (logging, caches) that a thread was holding at that moment,
+        # and hang as soon as it tries to take it
+        self.executor.submit(os.getpid).result()
+
+        self.queue = []
+        self.counter = itertools.count()  # keeps the order of equal things
+        self.unfinished = 0
+        self.condition = threading.Condition()
+
+        self.rendering = 0
+        self.capacity = 1
+        self.capacity_checked = 0
+        self.render_condition = threading.Condition()
+        self.ladder = Ladder()
+        self.durations = deque(maxlen=100)
+
+        for _ in range(io_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def put(self, thing, priority=0, deadline=None):
+        """deadline: time.time() after which the thing is not worth doing"""
+        with self.condition:
+            heapq.heappush(self.queue,
+                           (priority, next(self.counter), deadline, thing))
+            self.unfinished += 1
+            self.condition.notify()
+
+    def join(self):
+        """waits until everything that was put has been done"""
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                _, _, deadline, thing = heapq.heappop(self.queue)
+
+            try:
+                if deadline and time.time() > deadline:
+                    utils.logger.warning('Dropping %r, its deadline has '
+                                         'passed', thing)
+                else:
+                    self.func(thing, functools.partial(self.render,
+                                                       deadline=deadline))
+            except Exception:
+                utils.logger.exception('Error processing %r', thing)
+            finally:
+                with self.condition:
+                    self.unfinished -= 1
+                    self.condition.notify_all()
+
+    def render(self, text, deadline=None, **kwargs):
+        """makes an Akari and returns it. raises RenderTimeoutError if it's
+            not ready by the deadline, and RenderQueueFullError if the
+            system stays too busy to render anything until then"""
+        with self.render_condition:
+            while True:
+                step = self.ladder.update(self._pressure())
+                if step is not None:
+                    break
+                # wait for things to calm down, as long as there's time
+                if not deadline or time.time() > deadline:
+                    raise RenderQueueFullError('Too busy to render')
+                self.render_condition.wait(self.CAPACITY_INTERVAL)
+        # stills are cheap enough already
+        if kwargs.get('type') == 'animation':
+            kwargs.update(step)
+
+        # searching and downloading happen in this thread. only composing
+        # takes up a worker process
+        composer = functools.partial(self._compose, deadline=deadline)
+        return Akari(text, composer=composer, **kwargs)
+
+    def _compose(self, akari, image, deadline=None):
+        """composes a downloaded image in a worker process, as soon as there
+            is room for it, and returns the composed Akari"""
+        with self.render_condition:
+            while self.rendering >= self._capacity():
+                if deadline and time.time() > deadline:
+                    raise RenderTimeoutError('No room to render before the '
+                                             'deadline')
+                # a render that finishes wakes us up, but the capacity can
+                # also change on its own, so look again after a while
+                self.render_condition.wait(self.CAPACITY_INTERVAL)
+            self.rendering += 1
+
+        # the render is counted until its worker is done with it
+        future = submit(self.executor, self._render_done,
+                        _compose, akari, image)
+
+        start = time.time()
+        timeout = max(deadline - start, 0) if deadline else None
+        try:
+            result = future.result(timeout)
+            self._took(start)
+            return result
+        except TimeoutError:
+            # it took at least this long
+            self._took(start)
+            future.cancel()
+            raise RenderTimeoutError('Render not ready by its deadline')
+
+    def _took(self, start):
+        now = time.time()
+        with self.render_condition:
+            self.durations.append((now, now - start))
+
+    def _render_done(self):
+        with self.render_condition:
+            self.rendering -= 1
+            # both render() and _compose() wait on this condition, for
+            # different things, so all of them have to look
+            self.render_condition.notify_all()
+
+    def _pressure(self):
+        """returns how close the system is to its limit, 1 being right at
+            it. must be called with render_condition held"""
+        with self.condition:
+            waiting = len(self.queue)
+        pressure = ((waiting + self.rendering) /
+                    (self._capacity() * self.QUEUE_TARGET))
+
+        # old renders are forgotten, or nothing would change while nothing
+        # is being rendered
+        since = time.time() - self.DURATION_WINDOW
+        durations = sorted(duration for end, duration in self.durations
+                           if end > since)
+        if durations:
+            p95 = durations[int(len(durations) * 0.95)]
+            pressure = max(pressure, p95 / self.render_target)
+
+        memory = available_memory()
+        if memory is not None:
+            # enough memory for a couple more renders is alright
+            pressure = max(pressure,
+                           2 * self.render_memory / max(memory, 1))
+
+        return pressure
+
+    def _capacity(self):
+        """returns how many renders may run at once. must be called with
+            render_condition held"""
+        now = time.time()
+        if now - self.capacity_checked < self.CAPACITY_INTERVAL:
+            return self.capacity
+        self.capacity_checked = now
+
+        # the renders that are running already count as load and take
+        # memory, so they are added back
+        capacity = self.render_workers
+        try:
+            idle = (os.cpu_count() or 1) - os.getloadavg()[0]
+            capacity = min(capacity, int(idle) + self.rendering)
+        except OSError:
+            pass
+        memory = available_memory()
+        if memory is not None:
+            capacity = min(capacity,
+                           memory // self.render_memory + self.rendering)
+
+        # never stop rendering altogether
+        capacity = max(capacity, 1)
+        if capacity != self.capacity:
+            utils.logger.info('Render capacity: %d', capacity)
+        self.capacity = capacity
+        return capacity
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,94 @@
+from datetime import datetime
+import re
+
+import numpy
+
+import utils
+
+
+NOT_LETTERS = re.compile(r'[^a-zA-Z]+')
+
+
+class Scorer(object):
+    """scores the candidates of the cron job. the features of each status are
+        extracted once, when it is added, and then all scores are computed
+        at once. it doesn't read the config, so it can also be used to
+        score dumps of statuses offline"""
+    def __init__(self, interval, lang_whitelist=None, filter_quotes=False,
+                 now=None):
+        self.interval = interval  # seconds
+        self.lang_whitelist = set(lang_whitelist or ())
+        self.filter_quotes = filter_quotes
+        self.now = now or datetime.utcnow()
+
+        self.statuses = []
+        self.features = []
+
+    def add(self, statuses):
+        """extracts the features of some statuses. can be called as they
+            arrive, before all of them are there"""
+        for status in statuses:
+            self.statuses.append(status)
+            self.features.append(self._features(status))
+
+    def _features(self, status):
+        user = status.user
+        clean_text = utils.clean_status(status,
+                                        urls=True, replies=True, rts=True)
+        letters = len(NOT_LETTERS.sub('', clean_text))
+        # a status without text has no letters at all
+        ratio = letters / len(clean_text) if clean_text else 0
+        penalized = ((self.lang_whitelist and
+                      user.lang not in self.lang_whitelist) or
+                     (self.filter_quotes and status.is_quote_status))
+        return (status.favorite_count,
+                status.retweet_count,
+                user.followers_count,
+                (self.now - status.created_at).total_seconds(),
+                ratio,
+                bool(user.protected),
+                bool(penalized))
+
+    def scores(self):
+        """returns the score of every status, in the order they were added.
+            protected users and users without followers get -1"""
+        if not self.features:
+            return numpy.empty(0)
+
+        columns = numpy.array(self.features, dtype=numpy.float64).T
+        favs, rts, followers, age, ratio, protected, penalized = columns
+        protected = protected.astype(bool) | (followers == 0)
+
+        # decay coefficient. promotes newer tweets to compensate for the
+        # lower amount of favs they have received (fewer people have seen
+        # them, in theory). it's the same as utils.decay()
+        threshold = numpy.clip(self.interval - age, 0, None)
+        scores = 1 + threshold * 1.5 / self.interval
+        # followers are 1 where the score is going to be -1 anyway
+        scores *= (favs + rts * 2) / numpy.where(protected, 1, followers)
+
+        # apply penalties. some tweets carry a penalty but are not removed
+        # right away, in case there isn't anything better.
+        # at least 80% of letters in the status must be /a-zA-Z/
+        faved = favs[favs > 0]
+        favs_median = numpy.median(faved) if len(faved) else 0
+        penalized = (penalized.astype(bool) | (ratio < 0.8) |
+                     (followers < numpy.median(followers) * 1.5) |
+                     (favs < favs_median))
+        scores[penalized] /= 10
+
+        scores[protected] = -1
+        return scores
+
+    def top(self, k):
+        """returns the k statuses with the highest scores, best first"""
+        scores = self.scores()
+        if k < len(scores):
+            best = numpy.argpartition(-scores, k)[:k]
+        else:
+            best = numpy.arange(len(scores))
+        # only the chosen ones are sorted. the sort is stable, so ties are
+        # in the order they were added
+        best.sort()
+        best = best[numpy.argsort(-scores[best], kind='stable')]
+        return [self.statuses[i] for i in best]
@@ -0,0 +1,168 @@
+import contextlib
+import fcntl
+import os
+import threading
+
+from config import cfg
+import utils
+
+
+class Store(object):
+    """a directory of files that is kept under max_size bytes. when it goes
+        over that, the least recently used files are removed.
+        every file that is added or removed appends its size to a log, which
+        is shared by all processes. each process keeps a running total and
+        only reads the lines that are new since the last time, so nothing
+        has to be locked or rewritten until the store is too big. then the
+        directory is scanned, files are evicted and the log is written again
+        with what is left, with a lock file serializing that"""
+    LOG = 'index.log'
+    LOCK = 'index.lock'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        # size of the store, as of self.offset bytes into the log that is
+        # at self.inode
+        self.size = 0
+        self.offset = 0
+        self.inode = None
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """returns the path of a file if it's in the store, or None"""
+        path = self.path(name)
+        try:
+            # the modification time is what tells how recently it was used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @contextlib.contextmanager
+    def put(self, name):
+        """gives a temporary path to write a file to. once the block is over,
+            the file is moved into the store, so nobody ever sees it half
+            written. if the block raises an exception, the file is thrown
+            away. the name of the temporary file ends like the real one, so
+            the extension can still be used to tell the format"""
+        tmp_path = self.path('.%d.%d.%s' % (os.getpid(),
+                                            threading.get_ident(), name))
+        try:
+            yield tmp_path
+            os.replace(tmp_path, self.path(name))
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+        if not os.path.exists(self.path(self.LOG)):
+            # the log has not been started yet. the scan counts this file
+            self._rebuild()
+        else:
+            self._log(name, os.path.getsize(self.path(name)))
+        if self._total() > self.max_size:
+            self._rebuild()
+
+    def remove(self, name):
+        path = self.path(name)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self._log(name, -size)
+
+    def _log(self, name, size):
+        """appends a change in size to the log. a line this short is written
+            all at once, even if other processes are appending at the same
+            time"""
+        line = '%d %s\n' % (size, name)
+        fd = os.open(self.path(self.LOG),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def _total(self):
+        """returns the size of the store according to the log. only the
+            lines that are new since the last call are read"""
+        with self.lock:
+            try:
+                with open(self.path(self.LOG), 'rb') as fp:
+                    inode = os.fstat(fp.fileno()).st_ino
+                    if inode != self.inode:
+                        # it has been written again, so start over
+                        self.inode, self.offset, self.size = inode, 0, 0
+                    fp.seek(self.offset)
+                    data = fp.read()
+            except FileNotFoundError:
+                return self.size
+
+            # a line that is still being written is left for the next time
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                self.size += int(line.split(b' ', 1)[0])
+            self.offset += end
+            return self.size
+
+    def _rebuild(self):
+        """scans the directory, evicts files if it's too big and writes the
+            log again with the files that are left"""
+        with open(self.path(self.LOCK), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # somebody else may have done it while we were waiting
+            if (os.path.exists(self.path(self.LOG)) and
+                    self._total() <= self.max_size):
+                return
+
+            index = self._scan()
+            if sum(index.values()) > self.max_size:
+                self._evict(index)
+
+            tmp_path = self.path(self.LOG + '.tmp')
+            with open(tmp_path, 'w') as fp:
+                for name, size in index.items():
+                    fp.write('%d %s\n' % (size, name))
+            os.replace(tmp_path, self.path(self.LOG))
+
+    def _scan(self):
+        """rebuilds the index from the contents of the directory"""
+        index = {}
+        for entry in os.scandir(self.directory):
+            if (entry.is_file() and not entry.name.startswith('.') and
+                    entry.name not in (self.LOG, self.LOCK)):
+                index[entry.name] = entry.stat().st_size
+        return index
+
+    def _evict(self, index):
+        """removes the least recently used files until the store is at 90%
+            of its size"""
+        used = {}
+        for name in list(index):
+            try:
+                used[name] = os.stat(self.path(name)).st_mtime
+            except FileNotFoundError:
+                del index[name]
+
+        size = sum(index.values())
+        target = self.max_size * 0.9
+        for name in sorted(used, key=used.get):
+            if size <= target:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(name))
+            size -= index.pop(name)
+
+        utils.logger.info('Store "%s" evicted down to %d bytes',
+                          self.directory, size)
+
+
+# this is where downloaded images and generated captions are stored
+images = Store('images', (cfg('image_search:store_size:int') or 1024) *
+               1024 * 1024)
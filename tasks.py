@@ -1,9 +1,11 @@
+import asyncio
 from datetime import datetime, timedelta
 
 import tweepy
 
-from config import cfg
+from config import cfg, settings
 from twitter import twitter
+from twitter_aio import TwitterAPIError
 import utils
 
 
@@ -27,18 +29,45 @@ def follow_my_followers():
                         return
 
 
+# friendships/destroy sends no rate limit headers, so the client can't slow
+# down on its own. unfollowing a lot of people at once can get the account
+# locked
+MAX_CONCURRENT_UNFOLLOWS = 2
+
+
 def unfollow_my_unfollowers():
-    # 100 per page is the max lookup_friendships can do
-    for page in tweepy.Cursor(twitter.api.friends, count=100).pages():
-        user_ids = [user.id for user in page]
-        for relationship in twitter.api._lookup_friendships(user_ids):
-            if not relationship.is_followed_by:
-                utils.logger.info('Unfollowing @%s (%d)',
-                                  relationship.screen_name, relationship.id)
-                try:
-                    twitter.api.destroy_friendship(relationship.id)
-                except tweepy.error.TweepError:
-                    utils.logger.exception('Error unfollowing.')
+    client = twitter.aio()
+    try:
+        client.run(_unfollow_my_unfollowers(client))
+    finally:
+        client.close()
+
+
+async def _unfollow_my_unfollowers(client):
+    # friendships are looked up 100 at a time, which is the max
+    # lookup_friendships can do, and the unfollowers in every group are
+    # unfollowed as soon as it arrives. if the lookups are cut short by the
+    # rate limit, the groups that arrived are done anyway
+    friend_ids = await client.cursor('friends/ids', 'ids', count=5000)
+    slots = asyncio.Semaphore(MAX_CONCURRENT_UNFOLLOWS)
+
+    async def unfollow(relationship):
+        async with slots:
+            utils.logger.info('Unfollowing @%s (%d)',
+                              relationship['screen_name'], relationship['id'])
+            try:
+                await client.post('friendships/destroy',
+                                  user_id=relationship['id'])
+            except TwitterAPIError:
+                utils.logger.exception('Error unfollowing.')
+
+    async def unfollow_unfollowers(relationships):
+        await asyncio.gather(*(
+            unfollow(relationship) for relationship in relationships
+            if 'followed_by' not in relationship['connections']))
+
+    await client.lookup('friendships/lookup', 'user_id', friend_ids,
+                        callback=unfollow_unfollowers)
 
 
 def unfollow_spammers():
@@ -55,24 +84,25 @@ def unfollow_spammers():
 
 def is_eligible(user):
     """checks if a user is eligible to be followed."""
-    if (cfg('tasks:follow_max_friends:int') and
-            user.friends_count > cfg('tasks:follow_max_friends:int')):
+    tasks_settings = settings().tasks
+    if (tasks_settings.follow_max_friends and
+            user.friends_count > tasks_settings.follow_max_friends):
         utils.logger.info('@%s has too many friends: %d', user.screen_name,
                           user.friends_count)
         return False
-    if (cfg('tasks:follow_min_followers:int') and
-            user.followers_count < cfg('tasks:follow_min_followers:int')):
+    if (tasks_settings.follow_min_followers and
+            user.followers_count < tasks_settings.follow_min_followers):
         utils.logger.info('@%s has too few followers: %d', user.screen_name,
                           user.followers_count)
         return False
-    if (cfg('tasks:follow_only_lang:list') and
-            user.lang.lower() not in cfg('tasks:follow_only_lang:list')):
+    if (tasks_settings.follow_only_lang and
+            user.lang.lower() not in tasks_settings.follow_only_lang):
         utils.logger.info('@%s uses a language not in the whitelist: %s',
                           user.screen_name, user.lang.lower())
         return False
-    if cfg('tasks:follow_last_post_days:int') and hasattr(user, 'status'):
+    if tasks_settings.follow_last_post_days and hasattr(user, 'status'):
         delta_min = (datetime.now() -
-                     timedelta(days=cfg('tasks:follow_last_post_days:int')))
+                     timedelta(days=tasks_settings.follow_last_post_days))
         if user.status.created_at < delta_min:
             utils.logger.info('@%s has not posted anything for too long',
                               user.screen_name)
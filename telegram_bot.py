@@ -4,9 +4,9 @@ import random
 import telepot
 import telepot.aio
 
-from akari import Akari
 from config import cfg
 from image_search import ImageSearchNoResultsError
+from render import RenderQueueFullError, RenderService, RenderTimeoutError
 import utils
 
 
@@ -20,6 +20,8 @@ class TelegramBot(telepot.aio.Bot):
                       'example:\n/akari french fries')
     INVALID_CMD = ("I don't know what you mean by that. If you need help, "
                    'use /help.')
+    BUSY_MSG = "I'm too busy right now. Try again in a minute."
+    TIMEOUT_MSG = 'That took too long. Try again in a minute.'
     COMPOSING_MSGS = ('Okay, hold on a second...',
                       'Wait a moment...',
                       "I'm working on it...",
@@ -51,6 +53,12 @@ class TelegramBot(telepot.aio.Bot):
         self.rate_limit_exemptions = cfg('telegram:rate_limit_exemptions:'
                                          'int_list')
 
+        self.render_service = RenderService(
+            workers=cfg('telegram:render_workers:int'),
+            queue_size=cfg('telegram:render_queue_size:int'),
+            timeout=cfg('telegram:render_timeout:int'),
+            loop=self.loop)
+
     async def on_chat_message(self, message):
         try:
             content_type, chat_type, chat_id, _, msg_id = \
@@ -118,13 +126,27 @@ class TelegramBot(telepot.aio.Bot):
             msg = random.choice(self.COMPOSING_MSGS)
             await self.send_message(message, msg, quote_msg_id=msg_id)
 
-            # first, search...
+            # first, search... this runs in another process, so other chats
+            # are served while this one is being composed.
             try:
-                akari = Akari(rest, type='animation', shuffle_results=True)
+                akari = await self.render_service.render(
+                    chat_id, rest, type='animation', shuffle_results=True)
             except ImageSearchNoResultsError:
                 await self.send_message(message, 'No results.',
                                         quote_msg_id=msg_id)
                 return
+            except RenderQueueFullError:
+                utils.logger.warning('Message from %s: render queue is full',
+                                     longname)
+                await self.send_message(message, self.BUSY_MSG,
+                                        quote_msg_id=msg_id)
+                return
+            except RenderTimeoutError:
+                utils.logger.warning('Message from %s: render timed out',
+                                     longname)
+                await self.send_message(message, self.TIMEOUT_MSG,
+                                        quote_msg_id=msg_id)
+                return
 
             # then, if successful, send the pic
             utils.logger.info('Sending %s to %s', akari.filename, longname)
@@ -189,8 +211,8 @@ class TelegramBot(telepot.aio.Bot):
 
 
 if __name__ == '__main__':
-    Akari.warmup()
-
+    # there is no need to warm up Akari here: renders happen in the workers
+    # of the render service, and each of them warms itself up.
     bot = TelegramBot(cfg('telegram:token'))
 
     loop = asyncio.get_event_loop()
@@ -199,4 +221,5 @@ if __name__ == '__main__':
     try:
         loop.run_forever()
     finally:
+        bot.render_service.shutdown()
         loop.close()
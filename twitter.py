@@ -1,14 +1,28 @@
+from concurrent.futures import as_completed, ThreadPoolExecutor
 import json
+import os
+import threading
+import time
 
 import tweepy
 
+from cache import LRUCache
 from config import cfg
+import image_info
+from twitter_aio import AsyncTwitter, TwitterAPIError
 import utils
 
 
+# formats that can be uploaded, and their mime types
+MEDIA_TYPES = {'gif': 'image/gif', 'jpeg': 'image/jpeg', 'png': 'image/png',
+               'webp': 'image/webp'}
+
+
 class Twitter(object):
     MAX_STATUS_LENGTH = 280
     MAX_STATUS_WITH_MEDIA_LENGTH = 280
+    # media ids can be used for a day, but let's not push it
+    MEDIA_ID_TTL = 60 * 60
 
     def __init__(self,
                  consumer_key, consumer_secret,
@@ -22,12 +36,54 @@ class Twitter(object):
             self.me = self.api.me()
             self.bio_ok = cfg('twitter:bio_ok')
             self.bio_ratelimit = cfg('twitter:bio_ratelimit')
+            # (filename, size) -> media id
+            self.media_ids = LRUCache(maxsize=64, ttl=self.MEDIA_ID_TTL)
+            # every thread gets a client of its own to upload media, because
+            # each one has its own event loop
+            self.local = threading.local()
         except tweepy.error.TweepError as exc:
             Twitter.handle_exception(exc)
             raise
 
         utils.logger.info('Twitter API initialised.')
 
+    def aio(self, loop=None):
+        """returns an AsyncTwitter client for the same account"""
+        return AsyncTwitter(cfg('twitter:consumer_key'),
+                            cfg('twitter:consumer_secret'),
+                            cfg('twitter:access_token'),
+                            cfg('twitter:access_token_secret'),
+                            base_url=cfg('twitter:api_url'),
+                            upload_url=cfg('twitter:upload_url'), loop=loop)
+
+    def upload(self, filename):
+        """uploads an image in chunks and returns its media id. the same
+            file is only uploaded once in a while"""
+        # not the mtime, because the store touches files every time they
+        # are used. files in the store are never rewritten in place, so a
+        # new file with the same name is unlikely to have the same size
+        key = (os.path.abspath(filename), os.path.getsize(filename))
+        media_id = self.media_ids.get(key)
+        if media_id:
+            return media_id
+
+        with open(filename, 'rb') as fp:
+            format_, _, _ = image_info.sniff(fp.read(64 * 1024))
+        if format_ not in MEDIA_TYPES:
+            raise ValueError('Can\'t upload "%s"' % filename)
+        # gifs are uploaded as animations, even if there's only one frame
+        category = 'tweet_gif' if format_ == 'gif' else 'tweet_image'
+
+        try:
+            client = self.local.client
+        except AttributeError:
+            client = self.local.client = self.aio()
+        media_id = client.run(client.upload_media(filename,
+                                                  MEDIA_TYPES[format_],
+                                                  category))
+        self.media_ids.set(key, media_id)
+        return media_id
+
     def _update_bio(self, new_bio):
         if new_bio and self.me.description != new_bio:
             utils.logger.info('Setting new bio: "%s"', new_bio)
@@ -41,7 +97,7 @@ class Twitter(object):
     def post(self, status='', media=None, retries=5, **kwargs):
         # this is a wrapper around _post() so it's retried several times
         # if there's a server-side exception.
-        for _ in range(retries):
+        for attempt in range(retries):
             try:
                 self._post(status=status, media=media, **kwargs)
             except (tweepy.error.TweepError,
@@ -49,6 +105,8 @@ class Twitter(object):
                 api_code, _ = self.extract_exception(exc)
                 if api_code in {130, 131}:  # over capacity, internal error
                     utils.logger.info('Server-side error. Retrying...')
+                    # give it some time, it's not going to be fixed at once
+                    time.sleep(utils.backoff(attempt))
                 elif api_code == 185:  # over the rate limit
                     self._update_bio(self.bio_ratelimit)
                     raise
@@ -63,9 +121,23 @@ class Twitter(object):
             raise ValueError('Nothing to post.')
 
         if media:
+            # if this is a retry, the media has been uploaded already
+            try:
+                media_id = self.upload(media)
+            except TwitterAPIError as exc:
+                # so that post() and its callers handle these like any other
+                # error coming from the API
+                raise tweepy.error.TweepError(
+                    str([{'code': exc.code, 'message': exc.message}]),
+                    api_code=exc.code)
+            except (ValueError, OSError) as exc:
+                # a format that can't be uploaded, or a file that can't be
+                # read
+                raise tweepy.error.TweepError(str(exc))
             status = utils.ellipsis(status, self.MAX_STATUS_WITH_MEDIA_LENGTH)
             utils.logger.info('Posting "%s" with "%s"', status, media)
-            status = self.api.update_with_media(media, status=status, **kwargs)
+            status = self.api.update_status(status, media_ids=[media_id],
+                                            **kwargs)
         else:
             status = utils.ellipsis(status, self.MAX_STATUS_LENGTH)
             utils.logger.info('Posting "%s"', status)
@@ -74,6 +146,38 @@ class Twitter(object):
         url = self.status_to_url(status)
         utils.logger.info('Status posted successfully: %s', url)
 
+    def lookup_statuses(self, ids, workers=4):
+        """looks up a list of status ids, 100 at a time, which is the most
+            statuses_lookup() can do. the lookups run in parallel, and every
+            group of statuses is yielded as soon as it arrives. lookups stop
+            when they are about to go over the rate limit of the endpoint"""
+        groups = [ids[i:i + 100] for i in range(0, len(ids), 100)]
+        # 900 lookups every 15 minutes
+        hits = utils.ratelimit_hits([('twitter', 'statuses_lookup', 900, 900)
+                                     for _ in groups])
+        allowed = [group for group, hit in zip(groups, hits)
+                   if hit['allowed']]
+        if len(allowed) < len(groups):
+            utils.logger.warning('Rate limited: looking up only %d of %d '
+                                 'groups of statuses',
+                                 len(allowed), len(groups))
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(self.api.statuses_lookup, group)
+                   for group in allowed]
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except tweepy.error.TweepError:
+                    # the rest of the groups are still worth something
+                    utils.logger.exception('Error looking up statuses')
+        finally:
+            # in case the caller stopped early, don't run the rest
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
     @staticmethod
     def status_to_url(status):
         template = 'https://twitter.com/{user}/status/{id}'
@@ -0,0 +1,306 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import time
+from urllib.parse import quote
+import uuid
+
+import aiohttp
+from yarl import URL
+
+import utils
+
+
+class TwitterAPIError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__('%d %d: %s' % (status, code, message))
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class TwitterRateLimitError(TwitterAPIError):
+    pass
+
+
+def _quote(value):
+    # percent encoding as oauth wants it
+    return quote(str(value), safe='~')
+
+
+def _encode(params):
+    return '&'.join('%s=%s' % (_quote(k), _quote(v))
+                    for k, v in sorted(params.items()))
+
+
+class AsyncTwitter(object):
+    """a small asyncio client for the Twitter API. connections are kept
+        alive and shared by all requests. requests that fail because of
+        server side errors (130, 131, 5xx or no connection at all) are
+        retried with a jittered exponential backoff. the rate limit of every
+        endpoint is read from the headers of its responses, and requests to
+        an endpoint that has run out wait until it's reset.
+        responses are returned as they come, parsed from json.
+        base_url can point somewhere else, such as a local stub server.
+        the client has an event loop of its own, so it can also be used from
+        regular code with run()"""
+    API_URL = 'https://api.twitter.com/1.1/'
+    UPLOAD_URL = 'https://upload.twitter.com/1.1/'
+    RETRY_CODES = {130, 131}  # over capacity, internal error
+
+    def __init__(self, consumer_key, consumer_secret,
+                 access_token, access_token_secret,
+                 base_url=None, upload_url=None, connections=8, retries=5,
+                 max_wait=15 * 60, loop=None):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.access_token = access_token
+        self.access_token_secret = access_token_secret
+        self.base_url = base_url or self.API_URL
+        self.upload_url = upload_url or self.UPLOAD_URL
+        self.connections = connections
+        self.retries = retries
+        self.max_wait = max_wait  # secs to wait for a rate limit at most
+        self.own_loop = not loop
+        self.loop = loop or asyncio.new_event_loop()
+        self.session = None
+        # endpoint -> (requests left, time when it's reset)
+        self.rate_limits = {}
+
+    def run(self, coro):
+        """runs a coroutine of this client from regular code"""
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        if self.session:
+            self.run(self.session.close())
+            self.session = None
+        if self.own_loop:
+            self.loop.close()
+
+    def _get_session(self):
+        if not self.session:
+            # created here because it has to be created inside the loop
+            connector = aiohttp.TCPConnector(limit=self.connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    def _sign(self, method, url, params):
+        """returns the oauth 1.0a authorization header for this request"""
+        oauth = {'oauth_consumer_key': self.consumer_key,
+                 'oauth_nonce': uuid.uuid4().hex,
+                 'oauth_signature_method': 'HMAC-SHA1',
+                 'oauth_timestamp': str(int(time.time())),
+                 'oauth_token': self.access_token,
+                 'oauth_version': '1.0'}
+        base = '&'.join((method, _quote(url),
+                         _quote(_encode(dict(params, **oauth)))))
+        key = '%s&%s' % (_quote(self.consumer_secret),
+                         _quote(self.access_token_secret))
+        digest = hmac.new(key.encode('utf-8'), base.encode('utf-8'),
+                          hashlib.sha1).digest()
+        oauth['oauth_signature'] = base64.b64encode(digest).decode('ascii')
+        return 'OAuth ' + ', '.join('%s="%s"' % (_quote(k), _quote(v))
+                                    for k, v in sorted(oauth.items()))
+
+    async def _wait_rate_limit(self, endpoint):
+        left, reset = self.rate_limits.get(endpoint, (1, 0))
+        wait = reset - time.time() + 1
+        if left > 0 or wait <= 0:
+            return
+        if wait > self.max_wait:
+            raise TwitterRateLimitError(429, 88, 'Rate limited on %s for '
+                                        '%d more seconds' % (endpoint, wait))
+        utils.logger.warning('Rate limited on %s, waiting %d seconds',
+                             endpoint, wait)
+        await asyncio.sleep(wait)
+
+    def _track_rate_limit(self, endpoint, headers):
+        try:
+            self.rate_limits[endpoint] = (
+                int(headers['x-rate-limit-remaining']),
+                int(headers['x-rate-limit-reset']))
+        except (KeyError, ValueError):
+            pass
+
+    async def request(self, method, endpoint, params=None, files=None,
+                      upload=False):
+        """calls an endpoint, such as 'statuses/update', and returns the
+            response. params are signed and sent in the query string for
+            GET and in the body for POST. files is a dict of name -> bytes,
+            sent as a multipart body, which is not signed"""
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        url = (self.upload_url if upload else self.base_url) + endpoint
+        url += '.json'
+
+        for attempt in range(self.retries):
+            await self._wait_rate_limit(endpoint)
+
+            headers = {'Authorization': self._sign(method, url, params)}
+            if method == 'GET' or files:
+                request_url = URL(url + '?' + _encode(params), encoded=True)
+                # a multipart body can only be sent once, so it's made again
+                # for every try
+                body = None
+                if files:
+                    body = aiohttp.FormData()
+                    for name, content in files.items():
+                        body.add_field(name, content, filename=name)
+            else:
+                request_url = URL(url, encoded=True)
+                body = _encode(params)
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+            try:
+                async with self._get_session().request(
+                        method, request_url, data=body,
+                        headers=headers) as response:
+                    self._track_rate_limit(endpoint, response.headers)
+                    text = await response.text()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                utils.logger.info('Error connecting to %s: %r', endpoint,
+                                  exc)
+                await asyncio.sleep(utils.backoff(attempt))
+                continue
+
+            try:
+                result = json.loads(text) if text else None
+            except ValueError:
+                result = None
+            if status < 300:
+                return result
+
+            try:
+                error = result['errors'][0]
+                code, message = error['code'], error['message']
+            except (TypeError, KeyError, IndexError):
+                code, message = 0, text[:200]
+
+            if status == 429:
+                # wait for the reset if it's not too far away
+                _, reset = self.rate_limits.get(endpoint,
+                                                (0, time.time() + 60))
+                self.rate_limits[endpoint] = (0, reset)
+                continue
+            elif code in self.RETRY_CODES or status >= 500:
+                utils.logger.info('Server-side error %d on %s. Retrying...',
+                                  code or status, endpoint)
+                await asyncio.sleep(utils.backoff(attempt))
+                continue
+            raise TwitterAPIError(status, code, message)
+
+        raise TwitterAPIError(0, 0, 'Gave up on %s after %d tries' %
+                              (endpoint, self.retries))
+
+    async def upload_media(self, filename, media_type, category=None,
+                           chunk_size=1024 * 1024):
+        """uploads a file in chunks and returns its media id, which can be
+            used in any number of statuses for a while. a chunk that fails
+            is retried on its own, without uploading the rest again"""
+        size = os.path.getsize(filename)
+        result = await self.request('POST', 'media/upload', dict(
+            command='INIT', total_bytes=size, media_type=media_type,
+            media_category=category), upload=True)
+        media_id = result['media_id_string']
+
+        with open(filename, 'rb') as fp:
+            for segment in itertools.count():
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                await self.request('POST', 'media/upload', dict(
+                    command='APPEND', media_id=media_id,
+                    segment_index=segment), files={'media': chunk},
+                    upload=True)
+
+        result = await self.request('POST', 'media/upload', dict(
+            command='FINALIZE', media_id=media_id), upload=True)
+        # gifs and videos are processed after being uploaded, and they can't
+        # be used until that's over
+        info = result.get('processing_info')
+        while info and info['state'] in ('pending', 'in_progress'):
+            await asyncio.sleep(info.get('check_after_secs', 1))
+            result = await self.request('GET', 'media/upload', dict(
+                command='STATUS', media_id=media_id), upload=True)
+            info = result.get('processing_info')
+        if info and info['state'] == 'failed':
+            error = info.get('error', {})
+            raise TwitterAPIError(0, error.get('code', 0),
+                                  error.get('message', 'Processing failed'))
+
+        utils.logger.info('Uploaded "%s" as media %s', filename, media_id)
+        return media_id
+
+    async def get(self, endpoint, **params):
+        return await self.request('GET', endpoint, params)
+
+    async def post(self, endpoint, **params):
+        return await self.request('POST', endpoint, params)
+
+    async def timeline(self, endpoint, since_id=None, count=200, **params):
+        """returns every status of a timeline newer than since_id, newest
+            first. the pages of a timeline depend on the one before them,
+            so they are fetched one after another"""
+        statuses = []
+        max_id = None
+        while True:
+            page = await self.get(endpoint, since_id=since_id, max_id=max_id,
+                                  count=count, **params)
+            if not page:
+                return statuses
+            statuses.extend(page)
+            max_id = page[-1]['id'] - 1
+
+    async def cursor(self, endpoint, key, **params):
+        """returns all items of an endpoint that is paginated with cursors,
+            such as the ids of the friends of a user"""
+        items = []
+        cursor = -1
+        while cursor:
+            page = await self.get(endpoint, cursor=cursor, **params)
+            items.extend(page[key])
+            cursor = page.get('next_cursor')
+        return items
+
+    async def lookup(self, endpoint, key, values, size=100, method='GET',
+                     concurrency=2, callback=None, **params):
+        """calls an endpoint that takes a list of up to size values, such as
+            ids, for any number of values. up to concurrency groups are
+            requested at the same time, so the rate limit of the endpoint is
+            known before going too far. if callback is given, it's awaited
+            with the items of every group as soon as they arrive.
+            a group that fails is skipped, so the ones that worked are not
+            lost. once the endpoint is rate limited for too long, the rest
+            are skipped too. returns the items that were retrieved, in order"""
+        groups = [values[i:i + size] for i in range(0, len(values), size)]
+        slots = asyncio.Semaphore(concurrency)
+        rate_limited = False
+
+        async def fetch(group):
+            nonlocal rate_limited
+            async with slots:
+                if rate_limited:
+                    return []
+                try:
+                    page = await self.request(
+                        method, endpoint,
+                        dict(params, **{key: ','.join(map(str, group))}))
+                except TwitterRateLimitError as exc:
+                    # the rest would fail in the same way
+                    rate_limited = True
+                    utils.logger.warning('Giving up on %s: %s', endpoint, exc)
+                    return []
+                except TwitterAPIError:
+                    utils.logger.exception('Error calling %s', endpoint)
+                    return []
+            if callback:
+                await callback(page)
+            return page
+
+        pages = await asyncio.gather(*(fetch(group) for group in groups))
+        return [item for page in pages for item in page]
@@ -0,0 +1,5 @@
+from twitter_cron import mention_worker
+
+
+if __name__ == '__main__':
+    mention_worker()
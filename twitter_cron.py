@@ -1,12 +1,13 @@
-import os
 import random
+import time
 
 import tweepy
 
 from akari import Akari
 from cache import cache
-from config import cfg
-from parallel import Parallel
+from config import cfg, settings
+from pending import mentions, pending
+from scheduler import Scheduler
 from tasks import is_eligible
 from image_search import ImageSearchNoResultsError
 from twitter import twitter
@@ -15,7 +16,7 @@ import utils
 
 def process_timeline():
     """retrieves all tweets in the home timeline and then stores them in
-        pending.txt"""
+        the pending store"""
     params = dict(count=200)
     sources_whitelist = cfg('twitter:sources_whitelist:list')
 
@@ -51,7 +52,7 @@ def process_timeline():
         if (sources_whitelist and status.source not in sources_whitelist):
             continue
 
-        text = utils.clean(status.text, urls=True, replies=True, rts=True)
+        text = utils.clean_status(status, urls=True, replies=True, rts=True)
         if not text:
             continue
 
@@ -59,10 +60,7 @@ def process_timeline():
         filtered_statuses.append(status)
 
     if filtered_statuses:
-        with open('pending.txt', 'a') as p_file:
-            for status in filtered_statuses:
-                text_no_nl = utils.clean(status.text)
-                print('%d %s' % (status.id, text_no_nl), file=p_file)
+        pending.add(filtered_statuses)
         utils.logging.info('Retrieved %d new statuses (from %d to %d).',
                            len(filtered_statuses), filtered_statuses[0].id,
                            filtered_statuses[-1].id)
@@ -78,8 +76,97 @@ def process_mentions():
     if not cfg('twitter:user_requests:bool'):
         return
 
+    filtered_statuses = get_mentions()
+    if filtered_statuses:
+        Akari.warmup()
+
+        scheduler = make_scheduler()
+        for status in filtered_statuses:
+            put_request(scheduler, status)
+        scheduler.join()
+        scheduler.shutdown()
+
+
+def mention_worker():
+    """long-lived version of process_mentions(). everything is imported and
+        warmed up once, then the mentions timeline is polled every
+        mentions_interval seconds and new mentions are fed to a scheduler
+        that is always running"""
+    Akari.warmup()
+
+    def answer(status, render):
+        try:
+            process_request(status, render)
+        finally:
+            # answered, or given up on
+            mentions.remove(status.id)
+
+    scheduler = make_scheduler(answer)
+    # the mentions that were waiting when the worker was stopped
+    waiting = mentions.waiting()
+    if waiting:
+        utils.logging.info('Resuming %d waiting mentions.', len(waiting))
+    for status, deadline in waiting:
+        status = tweepy.models.Status.parse(twitter.api, status)
+        put_request(scheduler, status, deadline)
+
+    # polled with a client of its own, which keeps its connections open
+    client = twitter.aio()
+    interval = cfg('twitter:mentions_interval:int') or 20
+    utils.logging.info('Mention worker started, polling every %d seconds.',
+                       interval)
+
+    while True:
+        start = time.time()
+        if settings().twitter.user_requests:
+            try:
+                deadline = time.time() + request_deadline()
+                for status in get_mentions(client, queue=mentions,
+                                           deadline=deadline):
+                    put_request(scheduler, status, deadline)
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                utils.logger.exception('Error retrieving mentions.')
+        time.sleep(max(interval - (time.time() - start), 0))
+
+
+def make_scheduler(func=None):
+    # read from the settings, where a blank or bad number is just None
+    twitter_settings = settings().twitter
+    return Scheduler(func or process_request,
+                     io_workers=twitter_settings.process_threads or 3,
+                     render_workers=twitter_settings.render_workers,
+                     render_memory=(twitter_settings.render_memory or 300) *
+                     1024 * 1024,
+                     render_target=twitter_settings.render_target or 30)
+
+
+def request_deadline():
+    """secs after which a mention is not worth answering"""
+    return settings().twitter.request_deadline or 600
+
+
+def put_request(scheduler, status, deadline=None):
+    """queues a mention. users with more followers go first, and so do
+        requests to delete a caption, which are quick to do"""
+    text = utils.clean_status(status, urls=True, replies=True, rts=True)
+    delete_triggers = settings().twitter.delete_triggers
+    quick = bool(delete_triggers and delete_triggers.search(text))
+    if deadline is None:
+        deadline = time.time() + request_deadline()
+    scheduler.put(status, priority=(not quick, -status.author.followers_count),
+                  deadline=deadline)
+
+
+def get_mentions(client=None, queue=None, deadline=None):
+    """retrieves all new mentions and returns the ones that have to be
+        answered. the last id seen is saved, so mentions are returned once.
+        client: an AsyncTwitter to retrieve them with, instead of tweepy
+        queue:  a MentionQueue where they are saved, with their deadline,
+                before the last id is"""
     params = dict(count=200)
-    sources_whitelist = cfg('twitter:sources_whitelist:list')
+    sources_whitelist = settings().twitter.sources_whitelist
     mention_prefix = '@%s ' % twitter.me.screen_name.lower()
 
     try:
@@ -89,21 +176,27 @@ def process_mentions():
         params['since_id'] = since_id
     except Exception as exc:
         utils.logging.warning("There's no last id saved, so I will save the "
-                              'last id I see and then quit.')
+                              'last id I see and ignore everything before.')
         since_id = None
 
     filtered_statuses = []
-    statuses = [status for page in
-                tweepy.Cursor(twitter.api.mentions_timeline, **params).pages()
-                for status in page]
+    if client:
+        statuses = client.run(client.timeline('statuses/mentions_timeline',
+                                              **params))
+        statuses = tweepy.models.Status.parse_list(twitter.api, statuses)
+    else:
+        statuses = [status for page in
+                    tweepy.Cursor(twitter.api.mentions_timeline,
+                                  **params).pages()
+                    for status in page]
     # they are in reverse chronological order, so put them straight
     statuses = statuses[::-1]
     if not since_id:
         since_id = statuses[-1].id
         with open('state_mentions_timeline.txt', 'wt') as fp:
             fp.write(str(since_id))
-        utils.logging.info('New since_id=%d. Goodbye!', since_id)
-        return
+        utils.logging.info('New since_id=%d.', since_id)
+        return []
 
     for status in statuses:
         # ignore mentions that are not directed at me
@@ -125,25 +218,24 @@ def process_mentions():
         utils.logging.info('Retrieved %d new mentions (from %d to %d).',
                            len(filtered_statuses), filtered_statuses[0].id,
                            filtered_statuses[-1].id)
+        if queue:
+            queue.add(filtered_statuses, deadline)
         with open('state_mentions_timeline.txt', 'wt') as fp:
             fp.write(str(filtered_statuses[-1].id))
-
-        Akari.warmup()
-
-        parallel = Parallel(process_request, filtered_statuses,
-                            cfg('twitter:process_threads:int') or 3)
-        parallel.start()
     else:
         utils.logging.info('Retrieved no new mentions.')
 
+    return filtered_statuses
+
 
-def process_request(queue):
-    request_blacklist = cfg('twitter:request_blacklist:re_list')
-    user_images = cfg('twitter:user_images:bool')
-    delete_triggers = cfg('twitter:delete_triggers:re_list')
-    load_avg_still = cfg('twitter:load_avg_still:int')
-    no_results_image = cfg('twitter:no_results_image')
-    error_image = cfg('twitter:error_image')
+def process_request(status, render):
+    """answers a mention. render composes the image in another process"""
+    twitter_settings = settings().twitter
+    request_blacklist = twitter_settings.request_blacklist
+    user_images = twitter_settings.user_images
+    delete_triggers = twitter_settings.delete_triggers
+    no_results_image = twitter_settings.no_results_image
+    error_image = twitter_settings.error_image
 
     def process_self_delete(status):
         if not status.in_reply_to_status_id:
@@ -174,138 +266,118 @@ def process_request(queue):
                               status_del.text)
             return True
 
-    while True:
-        status = queue.get()
-        print_status(status)
-
-        text = utils.clean(status.text, urls=True, replies=True, rts=True)
-
-        # see if the text in this request is blacklisted. if so do nothing.
-        if (request_blacklist and
-                any(x.search(text) for x in request_blacklist)):
-            utils.logger.warning('Text is blacklisted, request ignored')
-            queue.task_done()
-            continue
+    print_status(status)
 
-        # see if there's an image (and if that's allowed)
-        image_url = None
-        try:
-            if user_images:
-                image_url = status.entities['media'][0]['media_url'] + ':orig'
-        except KeyError:
-            pass
+    text = utils.clean_status(status, urls=True, replies=True, rts=True)
 
-        # if there's a user-provided image but there's no text and we are
-        # generating still images, don't do anything at all (in this case,
-        # we would just copy the image around without doing anything useful)
-        if image_url and not text and len(cache.get('akari:frames')) < 2:
-            utils.logger.warning('Refusing to generate a still image from a '
-                                 'still image')
-            queue.task_done()
-            continue
+    # see if the text in this request is blacklisted. if so do nothing.
+    if request_blacklist and request_blacklist.search(text):
+        utils.logger.warning('Text is blacklisted, request ignored')
+        return
 
-        # if after being cleaned up the status turns out to be empty and
-        # there's no image, return
-        if not text and not image_url:
-            utils.logger.info('No text and no image. Nothing to do.')
-            queue.task_done()
-            continue
+    # see if there's an image (and if that's allowed)
+    image_url = None
+    try:
+        if user_images:
+            image_url = status.entities['media'][0]['media_url'] + ':orig'
+    except KeyError:
+        pass
+
+    # if there's a user-provided image but there's no text and we are
+    # generating still images, don't do anything at all (in this case,
+    # we would just copy the image around without doing anything useful)
+    if image_url and not text and len(cache.get('akari:masks')) < 2:
+        utils.logger.warning('Refusing to generate a still image from a '
+                             'still image')
+        return
 
-        if (delete_triggers and any(x.search(text) for x in delete_triggers)):
-            if process_self_delete(status):
-                queue.task_done()
-                continue
-        # if removal is not successful, we will generate a caption.
-
-        # apply a strict ratelimit to people with fewer than 25 followers
-        rate_limit_slow = utils.ratelimit_hit('twitter', 'global_slow', 5, 60)
-        if (status.author.followers_count < 25 and
-                not rate_limit_slow['allowed']):
-            utils.logger.info('%d - Ignoring because of low follower count',
-                              status.id)
-            queue.task_done()
-            continue
+    # if after being cleaned up the status turns out to be empty and
+    # there's no image, return
+    if not text and not image_url:
+        utils.logger.info('No text and no image. Nothing to do.')
+        return
 
-        # apply a lax ratelimit to the rest of users
-        rate_limit = utils.ratelimit_hit('twitter', 'global', 20, 60)
-        if not rate_limit['allowed']:
-            utils.logger.info('%d - Ignoring because of ratelimit', status.id)
-            queue.task_done()
-            continue
+    if delete_triggers and delete_triggers.search(text):
+        if process_self_delete(status):
+            return
+    # if removal is not successful, we will generate a caption.
+
+    # apply a strict ratelimit to people with fewer than 25 followers
+    rate_limit_slow = utils.ratelimit_hit('twitter', 'global_slow', 5, 60)
+    if (status.author.followers_count < 25 and
+            not rate_limit_slow['allowed']):
+        utils.logger.info('%d - Ignoring because of low follower count',
+                          status.id)
+        return
 
-        # so we'll generate something for this guy...
+    # apply a lax ratelimit to the rest of users. it's only hit once the
+    # strict one has let the request through, so requests that are
+    # ignored don't use up the slots of everybody else
+    rate_limit = utils.ratelimit_hit('twitter', 'global', 20, 60)
+    if not rate_limit['allowed']:
+        utils.logger.info('%d - Ignoring because of ratelimit', status.id)
+        return
 
-        # follow the user if he's new. if he does not follow back, he'll
-        # be unfollowed by followers.unfollow_my_unfollowers sometime later.
-        if is_eligible(status.author):
-            try:
-                twitter.api.create_friendship(status.author.screen_name)
-            except tweepy.error.TweepError:
-                pass
+    # so we'll generate something for this guy...
 
-        # if the one-minute load avg is greater than load_avg_still, generate
-        # still captions
+    # follow the user if he's new. if he does not follow back, he'll
+    # be unfollowed by followers.unfollow_my_unfollowers sometime later.
+    if is_eligible(status.author):
         try:
-            load_avg = os.getloadavg()[0]
-            if load_avg_still and load_avg > load_avg_still:
-                utils.logger.warning('Load average too high! (%i > %i)',
-                                     load_avg, load_avg_still)
-                akari_type = 'still'
-            else:
-                akari_type = 'animation'
-        except KeyError:
+            twitter.api.create_friendship(status.author.screen_name)
+        except tweepy.error.TweepError:
             pass
 
-        error = False
-        try:
-            akari = Akari(text, type=akari_type, shuffle_results=True,
-                          image_url=image_url)
-            text = akari.caption
-            image = akari.filename
-        except ImageSearchNoResultsError:
-            utils.logger.exception('No results')
-            msgs = ('I found nothing.',
-                    'No results.',
-                    "I didn't find anything.",
-                    'There are no results.')
-            text = random.choice(msgs)
-            image = no_results_image
-            error = True
-        except KeyboardInterrupt:
-            raise
-        except Exception:
-            utils.logger.exception('Error composing the image')
-            msgs = ("Can't hear ya...",
-                    "Ooops, I'm busy at the moment.",
-                    "I don't feel so well right now.",
-                    'Sorry, I fell asleep.')
-            text = '%s Try again a bit later.' % random.choice(msgs)
-            image = error_image
-            error = True
-
-        # start building a reply. prepend @nick of whoever we are replying to
-        if cfg('twitter:text_in_status:bool') or error:
-            reply = '@%s %s' % (status.author.screen_name, text)
-        else:
-            reply = '@%s' % (status.author.screen_name)
-
-        # post it
-        try:
-            twitter.post(status=reply, media=image,
-                         in_reply_to_status_id=status.id)
-        except KeyboardInterrupt:
-            raise
-        except tweepy.error.TweepError as exc:
-            utils.logger.exception('Error posting.')
-            if exc.api_code == 326:  # account temporarily locked
-                twitter.handle_exception(exc)
-        except Exception:
-            utils.logger.exception('Error posting.')
+    # if the system is busy, the scheduler makes the animation cheaper, or
+    # even a still
+    error = False
+    try:
+        akari = render(text, type='animation', shuffle_results=True,
+                       image_url=image_url)
+        text = akari.caption
+        image = akari.filename
+    except ImageSearchNoResultsError:
+        utils.logger.exception('No results')
+        msgs = ('I found nothing.',
+                'No results.',
+                "I didn't find anything.",
+                'There are no results.')
+        text = random.choice(msgs)
+        image = no_results_image
+        error = True
+    except KeyboardInterrupt:
+        raise
+    except Exception:
+        utils.logger.exception('Error composing the image')
+        msgs = ("Can't hear ya...",
+                "Ooops, I'm busy at the moment.",
+                "I don't feel so well right now.",
+                'Sorry, I fell asleep.')
+        text = '%s Try again a bit later.' % random.choice(msgs)
+        image = error_image
+        error = True
+
+    # start building a reply. prepend @nick of whoever we are replying to
+    if twitter_settings.text_in_status or error:
+        reply = '@%s %s' % (status.author.screen_name, text)
+    else:
+        reply = '@%s' % (status.author.screen_name)
 
-        queue.task_done()
+    # post it
+    try:
+        twitter.post(status=reply, media=image,
+                     in_reply_to_status_id=status.id)
+    except KeyboardInterrupt:
+        raise
+    except tweepy.error.TweepError as exc:
+        utils.logger.exception('Error posting.')
+        if exc.api_code == 326:  # account temporarily locked
+            twitter.handle_exception(exc)
+    except Exception:
+        utils.logger.exception('Error posting.')
 
 
 def print_status(status):
     utils.logger.info('%d - "%s" by %s via %s',
-                      status.id, utils.clean(status.text),
+                      status.id, utils.clean_status(status),
                       status.author.screen_name, status.source)
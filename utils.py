@@ -1,14 +1,19 @@
+from concurrent.futures import Future
 import functools
 import hashlib
 import html
+import json
 import logging
-import pickle
+import os
+import random
 import re
 import textwrap
 import threading
+import time
 
 import requests
 
+from cache import LRUCache
 from config import cfg
 
 
@@ -30,6 +35,43 @@ class Logger(object):
 logger = Logger().get_logger()
 
 
+# hits a ratelimit, all in one go, so concurrent hits can't get in between.
+# it's a sliding window: every hit allowed is kept in a sorted set, scored by
+# its time, and the ones older than the window are removed before counting.
+# hits that are not allowed are not kept, so they don't lock users out for
+# longer. returns whether the hit was allowed, the number of hits in the
+# window (this one included) and the secs until the oldest of them leaves it.
+RATELIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local hits = redis.call('ZCARD', KEYS[1])
+local allowed = 0
+if hits < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    hits = hits + 1
+    allowed = 1
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+local reset = 0
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if oldest[2] then
+    reset = math.ceil(tonumber(oldest[2]) + window - now)
+end
+return {allowed, hits, reset}
+"""
+
+# releases a lock only if it's still held by whoever took it, which is known
+# by the token it was taken with. it may have expired and been taken by
+# someone else in the meantime.
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
 class DB(object):
     """wrapper for redis"""
     server_available = False
@@ -39,6 +81,9 @@ class DB(object):
             import redis
             self.server = redis.Redis(socket_connect_timeout=1)
             self.server.ping()
+            self.ratelimit_script = self.server.register_script(
+                RATELIMIT_SCRIPT)
+            self.unlock_script = self.server.register_script(UNLOCK_SCRIPT)
             self.server_available = True
         except ImportError as exc:
             logger.warning('Redis library could not be imported: %s', exc)
@@ -54,39 +99,44 @@ def ratelimit_hit(prefix, user, max_=50, ttl=60 * 10):
         In:
             prefix: prefix of the ratelimit (twitter, etc)
             user:   postfix of the ratelimit (a specific user, general, etc)
-            max_:   max number of hits allowed in ttl secs
-            ttl:    secs until the ratelimit is reset (default: 10 mins)
+            max_:   max number of hits allowed in any ttl secs
+            ttl:    length of the window in secs (default: 10 mins)
         Out:
             allowed: whether the hit was allowed
-            left:    hits left until next reset
-            reset:   seconds left until next reset
+            left:    hits left right now
+            reset:   secs until the oldest hit leaves the window, which
+                     frees a hit
+    """
+    return ratelimit_hits([(prefix, user, max_, ttl)])[0]
+
+
+def ratelimit_hits(ratelimits):
+    """Hits several ratelimits in a single round trip to the server.
+        In:
+            ratelimits: list of (prefix, user, max_, ttl), as in
+                        ratelimit_hit()
+        Out:
+            list with the result of each hit, as in ratelimit_hit()
     """
     def r(x, y, z):
         return {'allowed': x, 'left': y, 'reset': z}
     # if the server is not available, let it through
     if not db.server_available:
-        return r(True, 1, 0)
-
-    key = '%s:%s' % (prefix, user)
-    value = db.server.get(key)
-    if not value:
-        # if key does not exist...
-        db.server.set(key, 1)
-        db.server.expire(key, ttl)
-        return r(True, max_ - 1, ttl)
-    else:
-        current_ttl = db.server.ttl(key)
-        if not current_ttl:
-            # for some reason sometimes redis stores the keys with no ttl.
-            # this means the ratelimit is never reset and the bot stays locked.
-            # if that happens just remove the key and accept the hit.
-            db.server.delete(key)
-            return r(True, max_ - 1, ttl)
-        if int(value) >= max_:
-            return r(False, 0, current_ttl)
-        else:
-            db.server.incr(key)
-            return r(True, max_ - 1 - int(value), current_ttl)
+        return [r(True, 1, 0) for _ in ratelimits]
+
+    now = time.time()
+    pipe = db.server.pipeline(transaction=False)
+    for prefix, user, max_, ttl in ratelimits:
+        # every hit needs a member of its own in the sorted set
+        hit_id = '%f:%d' % (now, random.getrandbits(32))
+        db.ratelimit_script(keys=['ratelimit:%s:%s' % (prefix, user)],
+                            args=[now, ttl, max_, hit_id], client=pipe)
+
+    ret = []
+    for (_, _, max_, _), (allowed, hits, reset) in zip(ratelimits,
+                                                       pipe.execute()):
+        ret.append(r(bool(allowed), max_ - hits, reset))
+    return ret
 
 
 def timedelta(time_):
@@ -117,25 +167,47 @@ regex_rts = re.compile(r'^RT @[a-zA-Z0-9_]+:\s')
 regex_replies = re.compile(r'@[a-zA-Z0-9_]+\s?')
 regex_hashtags = re.compile(r'#[a-zA-Z0-9_]+\s?')
 regex_urls = re.compile(r'https?://[\w\./]*\b')
-regex_whitespace = re.compile(r'\s+')
+
+
+@functools.lru_cache()
+def _clean_regex(replies, hashtags, rts, urls):
+    """returns a single regex that matches everything that has to be
+        removed, or None if there's nothing to remove"""
+    regexes = [regex for regex, enabled in ((regex_rts, rts),
+                                            (regex_replies, replies),
+                                            (regex_hashtags, hashtags),
+                                            (regex_urls, urls)) if enabled]
+    if not regexes:
+        return None
+    return re.compile('|'.join('(?:%s)' % x.pattern for x in regexes))
 
 
 def clean(text, replies=False, hashtags=False, rts=False, urls=False):
-    """cleans up text that comes from twitter."""
-    text = text.replace('\n', ' ')
-    text = text.replace('\r', ' ')
+    """cleans up text that comes from twitter. everything that has to be
+        removed is removed in a single pass, and whitespace is collapsed,
+        newlines included"""
     text = html.unescape(text)
-    if rts:
-        text = regex_rts.sub('', text)
-    if replies:
-        text = regex_replies.sub('', text)
-    if hashtags:
-        text = regex_hashtags.sub('', text)
-    if urls:
-        text = regex_urls.sub('', text)
-    text = regex_whitespace.sub(' ', text)
-    text = text.strip()
-    return text
+    regex = _clean_regex(replies, hashtags, rts, urls)
+    if regex:
+        text = regex.sub('', text)
+    return ' '.join(text.split())
+
+
+def clean_status(status, replies=False, hashtags=False, rts=False,
+                 urls=False):
+    """like clean(), for the text of a status. the result is kept in the
+        status, so the same status is only cleaned once for each set of
+        options, no matter how many times this is called"""
+    key = (replies, hashtags, rts, urls)
+    try:
+        cleaned = status._clean
+    except AttributeError:
+        cleaned = status._clean = {}
+    try:
+        return cleaned[key]
+    except KeyError:
+        text = cleaned[key] = clean(status.text, *key)
+        return text
 
 
 def ellipsis(text, max_length):
@@ -151,6 +223,13 @@ def decay(time_, max_time, coeff):
     return 1 + threshold * coeff / max_time
 
 
+def backoff(attempt, base=1, cap=60):
+    """returns the secs to wait before retrying for the attempt-th time
+        (starting at 0). it doubles every time, up to cap, and it's jittered
+        so clients that failed at once don't retry at once"""
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1)
+
+
 def background(func):
     """executes the function in a thread of its own"""
     @functools.wraps(func)
@@ -193,39 +272,149 @@ def make_key_id(*args, **kwargs):
     return h.hexdigest()
 
 
-def memoize(name, timeout=30):
-    def memoize_fn(func):
+class SingleFlight(object):
+    """makes concurrent calls that have the same key share a single call:
+        the first one does the job and the rest wait for its result"""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Future()
+        if not leader:
+            # somebody is doing this already. wait for them.
+            return flight.result()
+
+        try:
+            res = func(*args, **kwargs)
+            flight.set_result(res)
+            return res
+        except BaseException as exc:
+            flight.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+
+def coalesce(name):
+    """concurrent calls to the function in this process with the same
+        arguments share a single call"""
+    def coalesce_fn(func):
+        flights = SingleFlight()
+
         @functools.wraps(func)
         def new_fn(*args, **kwargs):
-            if not db.server_available:
-                # if redis is unavailable just do your job and return.
-                return func(*args, **kwargs)
+            key = '%s:%s' % (name, make_key_id(*args, **kwargs))
+            return flights.do(key, func, *args, **kwargs)
+        return new_fn
+    return coalesce_fn
 
-            key = 'memo:%s:%s' % (name, make_key_id(*args, **kwargs))
 
-            res = db.server.get(key)
-
-            if res:
-                try:
-                    res = pickle.loads(res)
-                    logger.info('Returning object from cache: %s for "%s/%s"',
-                                key, _make_hashable(args),
-                                _make_hashable(kwargs))
-                except TypeError:
-                    # this key got fucked up. remove it and pretend we didn't
-                    # see it
-                    db.server.delete(key)
-                    res = None
-                    logger.warning('Destroying corrupt object in cache: %s',
-                                   key)
-
-            if not res:
-                # not cached, we should calculate it.
-                res = func(*args, **kwargs)
-                db.server.set(key, pickle.dumps(res))
-                # ttl is set here so it cannot be overridden
-                db.server.expire(key, timeout)
+# max secs that a process waits for another one to calculate a memoized
+# result before doing it on its own
+MEMOIZE_LOCK_TIMEOUT = 15
 
+
+def memoize(name, timeout=30, negative_timeout=None, local_size=256):
+    """caches the results of a function in two levels: first, a small cache
+        in this process, and then redis, which is shared by all processes.
+        results have to be serializable as json, and lists come back as
+        lists even if they were tuples. empty results are cached too, but
+        only for negative_timeout seconds (by default, same as timeout).
+        None is never cached.
+        concurrent calls with the same arguments share a single call to the
+        function, whether they are in this process or in another one"""
+    negative_timeout = negative_timeout or timeout
+
+    def memoize_fn(func):
+        # the local cache doesn't know when the key expires in redis, so
+        # keep things there for a short time at most
+        local = LRUCache(maxsize=local_size, ttl=min(timeout, 60 * 5))
+        flights = SingleFlight()
+
+        def fetch(key, *args, **kwargs):
+            res = _memoize_get(key)
+            if res is None:
+                # not cached, we should calculate it.
+                res = _memoize_call(key, timeout, negative_timeout, func,
+                                    *args, **kwargs)
+            if res is not None:
+                local.set(key, res, None if res else
+                          min(negative_timeout, 60 * 5))
             return res
+
+        @functools.wraps(func)
+        def new_fn(*args, **kwargs):
+            key = 'memo:%s:%s' % (name, make_key_id(*args, **kwargs))
+
+            res = local.get(key)
+            if res is not None:
+                logger.debug('Returning object from local cache: %s', key)
+                return res
+
+            return flights.do(key, fetch, key, *args, **kwargs)
         return new_fn
     return memoize_fn
+
+
+def _memoize_get(key):
+    if not db.server_available:
+        return None
+
+    res = db.server.get(key)
+    if res is None:
+        return None
+
+    try:
+        res = json.loads(res.decode('utf-8'))
+    except ValueError:
+        # this key got fucked up. remove it and pretend we didn't see it
+        db.server.delete(key)
+        logger.warning('Destroying corrupt object in cache: %s', key)
+        return None
+
+    logger.debug('Returning object from cache: %s', key)
+    return res
+
+
+def _memoize_call(key, timeout, negative_timeout, func, *args, **kwargs):
+    """calls the function and caches its result. if another process is
+        calling it already, waits for it to cache its result instead"""
+    if not db.server_available:
+        return func(*args, **kwargs)
+
+    lock_key = 'lock:' + key
+    # tells our lock apart from the one somebody else takes after it expires
+    token = '%d:%d' % (os.getpid(), random.getrandbits(64))
+    locked = False
+    deadline = time.time() + MEMOIZE_LOCK_TIMEOUT
+    while time.time() < deadline:
+        # the lock expires on its own, in case its owner dies
+        locked = db.server.set(lock_key, token, nx=True,
+                               ex=MEMOIZE_LOCK_TIMEOUT)
+        if locked:
+            break
+        time.sleep(0.1)
+        res = _memoize_get(key)
+        if res is not None:
+            return res
+    else:
+        logger.warning('Gave up waiting for somebody else to calculate %s',
+                       key)
+
+    try:
+        res = func(*args, **kwargs)
+        if res is not None:
+            # ttl is set here so it cannot be overridden
+            db.server.set(key, json.dumps(res),
+                          ex=timeout if res else negative_timeout)
+        return res
+    finally:
+        if locked:
+            db.unlock_script(keys=[lock_key], args=[token])